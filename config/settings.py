@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mailing.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -51,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'mailing.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -119,6 +121,20 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    # Имена с хешем содержимого + сжатые копии .gz/.br (после collectstatic)
+    'staticfiles': {
+        'BACKEND': 'mailing.assets.CompressedManifestStaticFilesStorage',
+    },
+}
+
+# Срок кеширования статики с хешем в имени (1 год)
+STATIC_MAX_AGE = 60 * 60 * 24 * 365
 
 LOGIN_URL = '/accounts/login/'
 LOGIN_REDIRECT_URL = '/'
@@ -134,6 +150,14 @@ CACHES = {
 # Время жизни кеша в секундах (5 минут = 300 секунд)
 CACHE_TTL = 300
 
+# Сессии читаются из кеша, БД - запасное хранилище. Пользователь с группами
+# тоже кешируется (mailing.auth_backends). При нескольких процессах нужен общий
+# кеш (Redis, Memcached): с LocMemCache сброс кеша виден только своему процессу.
+# Сессия хранит путь бэкенда (BACKEND_SESSION_KEY): при смене
+# AUTHENTICATION_BACKENDS все ранее вошедшие пользователи разлогиниваются
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+AUTHENTICATION_BACKENDS = ['mailing.auth_backends.CachedModelBackend']
+
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 EMAIL_HOST = 'localhost'
@@ -146,3 +170,50 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 AUTH_USER_MODEL = 'users.User'
 
+# Адреса, с которых разрешено читать /metrics, кроме персонала (пустой список -
+# только персонал). Адрес - REMOTE_ADDR: за прокси на той же машине все запросы
+# приходят с 127.0.0.1, поэтому добавлять его можно только без прокси
+METRICS_ALLOWED_IPS = []
+
+# Профилирование запросов (заголовок X-Profile или ?_profile для суперпользователей)
+PROFILING_ENABLED = False
+# Доля случайно профилируемых запросов (0.01 = 1%)
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_DIR = BASE_DIR / 'profiles'
+
+# Размер пачки получателей при отправке рассылки
+MAILING_SEND_CHUNK_SIZE = 2000
+
+# Автодополнение в форме рассылки
+AUTOCOMPLETE_MIN_LENGTH = 2
+AUTOCOMPLETE_LIMIT = 20
+# Сколько раз воркеры пытаются отправить письмо одному получателю
+MAILING_DELIVERY_MAX_ATTEMPTS = 3
+# Пауза перед повтором после временной ошибки, в секундах (удваивается с каждой попыткой)
+MAILING_DELIVERY_RETRY_DELAY = 300
+# Время блокировки рассылки на один прогон отправки, в секундах
+MAILING_RUN_LOCK_TIMEOUT = 3600
+
+# Параллельная отправка: потоков SMTP на процесс-воркер
+MAILING_SEND_THREADS = 16
+# Лимиты на домен получателя: одновременных соединений и писем в секунду
+# (rate = 0 - без ограничения). Домен целиком отправляет один процесс-воркер,
+# поэтому лимиты не умножаются на число процессов
+MAILING_DOMAIN_DEFAULT_LIMIT = {'concurrency': 4, 'rate': 0}
+MAILING_DOMAIN_LIMITS = {
+    'gmail.com': {'concurrency': 2, 'rate': 10},
+    'mail.ru': {'concurrency': 2, 'rate': 5},
+    'yandex.ru': {'concurrency': 2, 'rate': 5},
+}
+
+# Отслеживание открытий и переходов: включать вместе с адресом сайта, доступным
+# получателям (например, 'https://mailing.example.com'). С адресом localhost
+# письма не отправляются (ImproperlyConfigured): ссылки в них не открылись бы
+TRACKING_ENABLED = False
+TRACKING_BASE_URL = ''
+# Буфер событий сбрасывается в БД по размеру или по времени (секунды)
+TRACKING_FLUSH_SIZE = 500
+TRACKING_FLUSH_INTERVAL = 5
+
+# Полнотекстовый поиск: сколько клиентов и сообщений показывать
+SEARCH_RESULTS_LIMIT = 50
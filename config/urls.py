@@ -16,9 +16,11 @@ Including another URLconf
 """
 
 
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.contrib.auth import views as auth_views
+from mailing.assets import serve_static
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -32,4 +34,10 @@ urlpatterns = [
     path('accounts/logout/',
          auth_views.LogoutView.as_view(next_page='/'),
          name='logout'),
-]
\ No newline at end of file
+]
+
+if not settings.DEBUG:
+    # В режиме DEBUG статику отдает runserver
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % settings.STATIC_URL.lstrip('/'), serve_static),
+    ]
@@ -1,18 +1,22 @@
 from django.contrib import admin
 from django.urls import reverse
 from django.utils.html import format_html
-from .models import Client, Message, Mailing, MailingAttempt
+from . import search
+from .models import (
+    Client, Delivery, DeliveryStat, Message, Mailing, MailingAttempt, MailingRun, RequestProfile, Segment,
+    TrackingEvent,
+)
 
 
 @admin.register(Mailing)
 class MailingAdmin(admin.ModelAdmin):
-    list_display = ('id', 'start_time', 'end_time', 'status', 'message', 'clients_count', 'send_button')
+    list_display = ('id', 'start_time', 'end_time', 'status', 'message', 'segment', 'clients_count', 'send_button')
     list_filter = ('status',)
     filter_horizontal = ('clients',)  # Удобный выбор клиентов
 
     def clients_count(self, obj):
-        """Количество клиентов в рассылке"""
-        return obj.clients.count()
+        """Количество получателей рассылки (клиенты сегмента или выбранные)"""
+        return obj.get_recipients().count()
 
     clients_count.short_description = 'Клиентов'
 
@@ -27,19 +31,77 @@ class MailingAdmin(admin.ModelAdmin):
     send_button.short_description = 'Действия'
 
 
+class FullTextSearchMixin:
+    """Поиск в админке через FTS5-индекс вместо LIKE '%...%' по search_fields"""
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term or not search.is_available():
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(pk__in=search.search_ids(self.model, search_term)), False
+
+
 # Остальные классы остаются без изменений
 @admin.register(Client)
-class ClientAdmin(admin.ModelAdmin):
+class ClientAdmin(FullTextSearchMixin, admin.ModelAdmin):
     list_display = ('full_name', 'email', 'comment')
-    search_fields = ('full_name', 'email')
+    search_fields = ('full_name', 'email', 'comment')
+
+
+@admin.register(Segment)
+class SegmentAdmin(admin.ModelAdmin):
+    list_display = ('name', 'owner', 'email_domain', 'comment_tags')
+    search_fields = ('name',)
 
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(FullTextSearchMixin, admin.ModelAdmin):
     list_display = ('subject', 'body')
+    search_fields = ('subject', 'body')
 
 
 @admin.register(MailingAttempt)
 class MailingAttemptAdmin(admin.ModelAdmin):
     list_display = ('mailing', 'attempt_time', 'status', 'server_response')
-    list_filter = ('status',)
\ No newline at end of file
+    list_filter = ('status',)
+
+
+@admin.register(Delivery)
+class DeliveryAdmin(admin.ModelAdmin):
+    list_display = (
+        'mailing', 'run', 'client', 'domain', 'status', 'attempts', 'lease_owner', 'lease_expires_at', 'sent_at',
+    )
+    list_filter = ('status',)
+    search_fields = ('domain',)
+    raw_id_fields = ('mailing', 'run', 'client')
+
+
+@admin.register(MailingRun)
+class MailingRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'mailing', 'triggered_by', 'started_at', 'finished_at')
+    raw_id_fields = ('mailing',)
+
+
+@admin.register(DeliveryStat)
+class DeliveryStatAdmin(admin.ModelAdmin):
+    list_display = ('day', 'mailing', 'owner', 'status', 'count')
+    list_filter = ('status', 'day')
+    raw_id_fields = ('mailing', 'owner')
+
+
+@admin.register(TrackingEvent)
+class TrackingEventAdmin(admin.ModelAdmin):
+    list_display = ('day', 'mailing', 'client', 'kind', 'count', 'first_seen', 'last_seen')
+    list_filter = ('kind', 'day')
+    raw_id_fields = ('mailing', 'client')
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'method', 'path', 'view_name', 'status_code',
+                    'duration_ms', 'query_count', 'query_time_ms', 'user')
+    list_filter = ('view_name', 'method')
+    search_fields = ('path', 'view_name')
+    readonly_fields = [field.name for field in RequestProfile._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
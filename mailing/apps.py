@@ -3,3 +3,25 @@ from django.apps import AppConfig
 
 class MailingConfig(AppConfig):
     name = 'mailing'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.contrib.auth.models import Group
+        from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save, pre_delete
+
+        from .auth_backends import group_changed, user_changed, user_groups_changed
+        from .models import Client, Message
+        from .search import create_tables, index_instance, unindex_instance
+
+        User = get_user_model()
+        post_save.connect(user_changed, sender=User)
+        post_delete.connect(user_changed, sender=User)
+        post_save.connect(group_changed, sender=Group)
+        pre_delete.connect(group_changed, sender=Group)
+        m2m_changed.connect(user_groups_changed, sender=User.groups.through)
+
+        # Полнотекстовый индекс клиентов и сообщений
+        post_migrate.connect(create_tables, sender=self)
+        for model in (Client, Message):
+            post_save.connect(index_instance, sender=model)
+            post_delete.connect(unindex_instance, sender=model)
@@ -0,0 +1,108 @@
+"""Статика для production: имена с хешем, сжатые копии и долгий кеш.
+
+collectstatic через CompressedManifestStaticFilesStorage кладет рядом с
+каждым файлом style.<hash>.css его копии style.<hash>.css.gz и .br.
+serve_static отдает подходящую копию по Accept-Encoding с заголовком
+Cache-Control: immutable - при изменении файла меняется его имя.
+Перед приложением обычно стоит nginx, который делает то же самое
+(gzip_static/brotli_static); view нужен, когда его нет.
+"""
+import gzip
+import mimetypes
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.http import FileResponse, Http404
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен, без него создаются только .gz
+    brotli = None
+
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.map')
+# Меньше этого размера сжатие не окупается
+MIN_COMPRESS_SIZE = 256
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    # Без collectstatic (тесты, DEBUG=False на машине разработчика) манифеста
+    # нет: ссылка ведет на исходное имя файла вместо ошибки при рендере шаблона
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            # Файла нет ни в манифесте, ни в STATIC_ROOT - хеш посчитать не из чего
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if not dry_run and not isinstance(processed, Exception):
+                self.compress(hashed_name)
+            yield name, hashed_name, processed
+
+    def compress(self, name):
+        if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+            return
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            content = f.read()
+        if len(content) < MIN_COMPRESS_SIZE:
+            return
+
+        variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(content)))
+        for suffix, compressed in variants:
+            if len(compressed) < len(content):
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+
+
+_hashed_names = None
+
+
+def _is_hashed(path):
+    """Файл из манифеста с хешем в имени: его содержимое никогда не меняется"""
+    global _hashed_names
+    if _hashed_names is None:
+        _hashed_names = set(getattr(staticfiles_storage, 'hashed_files', {}).values())
+    return path in _hashed_names
+
+
+def serve_static(request, path):
+    """Отдача собранной статики из STATIC_ROOT с учетом сжатых копий"""
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+    except ValueError:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    content_type, _ = mimetypes.guess_type(full_path)
+    accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    encoding = None
+    for suffix, name in (('.br', 'br'), ('.gz', 'gzip')):
+        if name in accept_encoding and os.path.isfile(full_path + suffix):
+            full_path, encoding = full_path + suffix, name
+            break
+
+    response = FileResponse(
+        open(full_path, 'rb'),
+        content_type=content_type or 'application/octet-stream',
+        filename=os.path.basename(path),
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+
+    if _is_hashed(path):
+        response.headers['Cache-Control'] = f'public, max-age={settings.STATIC_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
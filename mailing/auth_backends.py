@@ -0,0 +1,51 @@
+"""Бэкенд аутентификации, который не ходит в БД на каждом запросе.
+
+Пользователь вместе с группами кладется в кеш на время жизни сессии.
+Запись сбрасывается при изменении пользователя, его групп или самих групп.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+UserModel = get_user_model()
+
+
+def user_cache_key(user_id):
+    return f'auth_user:{user_id}'
+
+
+def invalidate_users(user_ids):
+    cache.delete_many([user_cache_key(user_id) for user_id in user_ids])
+
+
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = UserModel._default_manager.prefetch_related('groups').filter(pk=user_id).first()
+            if user is None:
+                return None
+            cache.set(key, user, settings.SESSION_COOKIE_AGE)
+        return user if self.user_can_authenticate(user) else None
+
+
+# Инвалидация (сигналы подключаются в MailingConfig.ready)
+def user_changed(sender, instance, **kwargs):
+    invalidate_users([instance.pk])
+
+
+def group_changed(sender, instance, **kwargs):
+    invalidate_users(instance.user_set.values_list('pk', flat=True))
+
+
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_users([instance.pk])
+    elif pk_set:
+        invalidate_users(pk_set)
+    else:
+        invalidate_users(instance.user_set.values_list('pk', flat=True))
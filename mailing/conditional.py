@@ -0,0 +1,53 @@
+"""Условные GET-запросы (ETag / Last-Modified) для страниц просмотра.
+
+Состояние страницы описывает дешевая функция state_func(request, ...),
+возвращающая (время последнего изменения, *прочие части) или None. Из нее
+строятся валидаторы; если у браузера актуальная копия, view не вызывается
+и возвращается 304 Not Modified.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+
+def conditional_view(state_func):
+    def get_state(request, *args, **kwargs):
+        # condition() вызывает etag_func и last_modified_func по отдельности
+        if not hasattr(request, '_conditional_state'):
+            state = state_func(request, *args, **kwargs)
+            # Непоказанные flash-сообщения есть только в свежем рендере
+            if state is not None and len(get_messages(request)):
+                state = None
+            request._conditional_state = state
+        return request._conditional_state
+
+    def etag(request, *args, **kwargs):
+        state = get_state(request, *args, **kwargs)
+        if state is None:
+            return None
+        # Страница зависит от пользователя и CSRF-токена в формах
+        parts = [request.resolver_match.view_name, request.user.pk,
+                 request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''), *state]
+        return hashlib.md5(repr(parts).encode()).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        state = get_state(request, *args, **kwargs)
+        return state[0] if state is not None else None
+
+    def decorator(view_func):
+        conditional = condition(etag_func=etag, last_modified_func=last_modified)(view_func)
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            response = conditional(request, *args, **kwargs)
+            # Браузер хранит копию, но перепроверяет ее при каждом открытии
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,167 @@
+"""Отправка с разбиением получателей по домену почты.
+
+Крупные почтовые сервисы ограничивают прием писем с одного IP. Поэтому у
+каждого домена своя очередь и свои лимиты (одновременных отправок и писем в
+секунду, MAILING_DOMAIN_LIMITS), а в разные домены письма уходят
+параллельно: медленный домен задерживает только свою очередь.
+
+DomainDispatcher ведет очереди в вызывающем потоке; потоки пула только
+отправляют письма, поэтому с БД работает один поток. Сколько строк можно
+держать в очередях, он оценивает по измеренному времени отправки: все
+захваченное должно уйти, пока действует аренда.
+"""
+import math
+import time
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+
+def email_domain(email):
+    return email.rpartition('@')[2].strip().lower()
+
+
+def domain_hash(domain):
+    """Хеш домена для деления очереди между процессами.
+
+    Встроенный hash() строк меняется от запуска к запуску, crc32 - нет.
+    """
+    return zlib.crc32(domain.encode()) & 0x7fffffff
+
+
+class DomainLimit:
+    """Лимит одного домена: одновременные отправки и минимальный интервал между ними"""
+
+    def __init__(self, concurrency, rate=0):
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.interval = 1 / rate if rate else 0.0
+        self.active = 0
+        self.next_at = 0.0
+
+    @classmethod
+    def for_domain(cls, domain):
+        config = settings.MAILING_DOMAIN_LIMITS.get(domain, settings.MAILING_DOMAIN_DEFAULT_LIMIT)
+        return cls(config['concurrency'], config.get('rate', 0))
+
+    def capacity(self, seconds, send_time, limit):
+        """Сколько писем домен успеет отправить за seconds (не больше limit)"""
+        count = min(limit, self.concurrency * seconds / send_time)
+        if self.rate:
+            count = min(count, self.rate * seconds)
+        return max(1, math.floor(count))
+
+    def ready(self, now):
+        return self.active < self.concurrency and now >= self.next_at
+
+    def acquire(self, now):
+        self.active += 1
+        self.next_at = max(now, self.next_at) + self.interval
+
+    def release(self):
+        self.active -= 1
+
+
+class DomainDispatcher:
+    """Очереди по доменам поверх общего пула потоков.
+
+    send(item) выполняется в потоке пула и возвращает результат отправки;
+    остальные методы вызываются из одного (основного) потока.
+    """
+
+    # Начальная оценка времени одной отправки, с; уточняется по замерам
+    INITIAL_SEND_TIME = 1.0
+
+    def __init__(self, send, threads):
+        self.send = send
+        self.threads = threads
+        self.queues = {}
+        self.limits = {}
+        self.inflight = {}
+        self.send_time = self.INITIAL_SEND_TIME
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='mailing-send')
+
+    def limit(self, domain):
+        if domain not in self.limits:
+            self.limits[domain] = DomainLimit.for_domain(domain)
+        return self.limits[domain]
+
+    def queued(self, domain):
+        return len(self.queues.get(domain, ()))
+
+    def outstanding(self, domain=None):
+        """Взятые в работу и еще не завершенные элементы (домена или всего)"""
+        if domain is not None:
+            return self.queued(domain) + self.limit(domain).active
+        return sum(len(queue) for queue in self.queues.values()) + len(self.inflight)
+
+    def capacity(self, seconds):
+        """Сколько писем пул успеет отправить за seconds"""
+        return max(self.threads, math.floor(self.threads * seconds / self.send_time))
+
+    def domain_capacity(self, domain, seconds, limit):
+        return self.limit(domain).capacity(seconds, self.send_time, limit)
+
+    def held(self):
+        """Все элементы в очередях и в отправке"""
+        for queue in self.queues.values():
+            yield from queue
+        for _, item in self.inflight.values():
+            yield item
+
+    def add(self, domain, items):
+        self.limit(domain)
+        self.queues.setdefault(domain, deque()).extend(items)
+
+    def pending(self):
+        return bool(self.inflight) or any(self.queues.values())
+
+    def _timed_send(self, item):
+        started = time.perf_counter()
+        result = self.send(item)
+        return result, time.perf_counter() - started
+
+    def _dispatch(self):
+        """Запускает отправки, разрешенные лимитами; возвращает время следующей"""
+        now = time.monotonic()
+        wake_at = math.inf
+        for domain, queue in self.queues.items():
+            limit = self.limits[domain]
+            while queue and limit.ready(now):
+                item = queue.popleft()
+                limit.acquire(now)
+                self.inflight[self.executor.submit(self._timed_send, item)] = (domain, item)
+            if queue and limit.active < limit.concurrency:
+                wake_at = min(wake_at, limit.next_at)
+        return wake_at
+
+    def _complete(self, future):
+        domain, item = self.inflight.pop(future)
+        self.limits[domain].release()
+        result, elapsed = future.result()
+        if result is not None:
+            # Скользящее среднее: оценка следует за изменением скорости сервера
+            self.send_time = 0.8 * self.send_time + 0.2 * max(elapsed, 0.001)
+        return item, result
+
+    def collect(self, timeout=1.0):
+        """Запускает отправки и ждет завершения хотя бы одной; возвращает [(item, результат)]"""
+        wake_at = self._dispatch()
+        timeout = max(0.0, min(timeout, wake_at - time.monotonic()))
+        if not self.inflight:
+            # Все домены с письмами ждут своего интервала
+            time.sleep(timeout)
+            return []
+
+        done, _ = wait(self.inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+        return [self._complete(future) for future in done]
+
+    def close(self):
+        """Дожидается начатых отправок; возвращает (их результаты, неначатые элементы)"""
+        self.executor.shutdown(wait=True)
+        results = [self._complete(future) for future in list(self.inflight)]
+        leftovers = [item for queue in self.queues.values() for item in queue]
+        self.queues.clear()
+        return results, leftovers
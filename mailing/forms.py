@@ -1,7 +1,47 @@
 from django import forms
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.urls import reverse
 from django.utils import timezone
-from .models import Client, Message, Mailing
+from .models import Client, Message, Mailing, Segment
+
+
+class AutocompleteMixin:
+    """Виджет выбора, который рендерит только выбранные варианты.
+
+    Остальные варианты подгружаются скриптом autocomplete.js из JSON-эндпоинта,
+    поэтому размер страницы не зависит от количества клиентов и сообщений.
+    """
+
+    def __init__(self, url_name, attrs=None):
+        super().__init__(attrs)
+        self.url_name = url_name
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context['widget']['attrs']['data-autocomplete-url'] = reverse(self.url_name)
+        context['widget']['attrs']['data-autocomplete-min-length'] = settings.AUTOCOMPLETE_MIN_LENGTH
+        return context
+
+    def optgroups(self, name, value, attrs=None):
+        selected = [v for v in value if str(v).isdigit()]
+        if not selected:
+            return []
+
+        field = self.choices.field
+        groups = []
+        for index, obj in enumerate(self.choices.queryset.filter(pk__in=selected)):
+            option = self.create_option(name, obj.pk, field.label_from_instance(obj), True, index, attrs=attrs)
+            groups.append((None, [option], index))
+        return groups
+
+
+class AutocompleteSelect(AutocompleteMixin, forms.Select):
+    pass
+
+
+class AutocompleteSelectMultiple(AutocompleteMixin, forms.SelectMultiple):
+    pass
 
 
 class ClientForm(forms.ModelForm):
@@ -36,12 +76,15 @@ class ClientForm(forms.ModelForm):
     def clean_email(self):
         email = self.cleaned_data['email']
         # Проверяем, есть ли уже клиент с таким email (кроме текущего)
+        # all_objects: удаленный клиент занимает email, пока его не удалит purge_deleted
+        clients = Client.all_objects.filter(email=email)
         if self.instance.pk:  # если это редактирование существующего
-            if Client.objects.filter(email=email).exclude(pk=self.instance.pk).exists():
-                raise ValidationError('Клиент с таким email уже существует')
-        else:  # если это создание нового
-            if Client.objects.filter(email=email).exists():
-                raise ValidationError('Клиент с таким email уже существует')
+            clients = clients.exclude(pk=self.instance.pk)
+        client = clients.first()
+        if client is not None:
+            if client.is_deleted:
+                raise ValidationError('Клиент с таким email удаляется, повторите попытку позже')
+            raise ValidationError('Клиент с таким email уже существует')
         return email
 
     def save(self, commit=True):
@@ -95,7 +138,7 @@ class MessageForm(forms.ModelForm):
 class MailingForm(forms.ModelForm):
     class Meta:
         model = Mailing
-        fields = ['start_time', 'end_time', 'message', 'clients']
+        fields = ['start_time', 'end_time', 'message', 'clients', 'segment']
         widgets = {
             'start_time': forms.DateTimeInput(attrs={
                 'class': 'form-control',
@@ -105,14 +148,16 @@ class MailingForm(forms.ModelForm):
                 'class': 'form-control',
                 'type': 'datetime-local'
             }),
-            'message': forms.Select(attrs={'class': 'form-control'}),
-            'clients': forms.SelectMultiple(attrs={'class': 'form-control'}),
+            'message': AutocompleteSelect('message_autocomplete', attrs={'class': 'form-control'}),
+            'clients': AutocompleteSelectMultiple('client_autocomplete', attrs={'class': 'form-control'}),
+            'segment': forms.Select(attrs={'class': 'form-control'}),
         }
         labels = {
             'start_time': 'Время начала рассылки',
             'end_time': 'Время окончания рассылки',
             'message': 'Сообщение для отправки',
             'clients': 'Получатели (клиенты)',
+            'segment': 'Сегмент аудитории',
         }
 
     def __init__(self, *args, **kwargs):
@@ -123,12 +168,19 @@ class MailingForm(forms.ModelForm):
         if self.user:
             self.fields['message'].queryset = Message.objects.filter(owner=self.user)
             self.fields['clients'].queryset = Client.objects.filter(owner=self.user)
+            self.fields['segment'].queryset = Segment.objects.filter(owner=self.user)
 
     def clean(self):
         cleaned_data = super().clean()
         start_time = cleaned_data.get('start_time')
         end_time = cleaned_data.get('end_time')
 
+        if not cleaned_data.get('clients') and not cleaned_data.get('segment'):
+            raise ValidationError('Выберите клиентов или сегмент аудитории')
+        if cleaned_data.get('clients') and cleaned_data.get('segment'):
+            # Рассылка по сегменту не учитывает явно выбранных клиентов (Mailing.get_recipients)
+            raise ValidationError('Выберите либо клиентов, либо сегмент аудитории, но не то и другое')
+
         if start_time and end_time:
             if start_time >= end_time:
                 raise ValidationError('Время начала должно быть раньше времени окончания')
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mailing.purge import purge_deleted, purge_owner
+
+
+class Command(BaseCommand):
+    help = 'Удаляет пачками клиентов, сообщения и рассылки, помеченные на удаление'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Сколько строк удалять за одну транзакцию')
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help='Пауза между пачками, с (дает место другим записям в БД)')
+        parser.add_argument('--owner', type=int,
+                            help='Удалить пользователя с этим ID вместе со всеми его данными')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Повторять каждые N секунд (0 - выполнить один раз)')
+
+    def handle(self, *args, **options):
+        if options['owner']:
+            result = purge_owner(options['owner'], options['batch_size'], options['pause'])
+            self.report(result)
+            return
+
+        while True:
+            self.report(purge_deleted(options['batch_size'], options['pause']))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def report(self, result):
+        summary = ', '.join(f'{name}: {count}' for name, count in result.items())
+        self.stdout.write(self.style.SUCCESS(f'✅ Удалено - {summary}'))
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mailing.stats import rebuild_delivery_stats
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает сводную статистику доставки из истории попыток'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=0,
+            help='Пересчитать только последние N дней (0 - всю историю)',
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['days']:
+            since = timezone.localdate() - timedelta(days=options['days'] - 1)
+
+        total = rebuild_delivery_stats(since)
+        self.stdout.write(self.style.SUCCESS(f'✅ Строк сводки: {total}'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from mailing import search
+
+
+class Command(BaseCommand):
+    help = ('Пересобирает полнотекстовый индекс клиентов и сообщений (SQLite FTS5) '
+            'и заполняет ключи поиска')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Сколько объектов читать и вставлять за раз')
+
+    def handle(self, *args, **options):
+        for model in search.SEARCH_KEYS:
+            total = search.fill_search_keys(model, options['chunk_size'])
+            self.stdout.write(f'{model._meta.verbose_name_plural}: ключей поиска заполнено {total}')
+
+        if not search.is_available():
+            self.stdout.write(self.style.WARNING('⚠️ FTS5 есть только в SQLite, поиск работает через icontains'))
+            return
+        for model in search.INDEXES:
+            total = search.rebuild(model, options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS(f'✅ {model._meta.verbose_name_plural}: проиндексировано {total}'))
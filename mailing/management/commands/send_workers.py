@@ -0,0 +1,65 @@
+import multiprocessing
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from mailing.models import Mailing
+from mailing.services import enqueue_mailing, mailing_run
+from mailing.workers import worker_main
+
+
+class Command(BaseCommand):
+    help = 'Отправляет рассылки пулом процессов с арендой строк очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                            help='Количество процессов-воркеров')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Сколько получателей одного домена воркер захватывает за раз')
+        parser.add_argument('--lease-seconds', type=int, default=300,
+                            help='Время аренды пачки; должно превышать время ее отправки')
+        parser.add_argument('--mailing', type=int, action='append', dest='mailings',
+                            help='ID рассылки (можно указать несколько раз); '
+                                 'по умолчанию - запущенные рассылки, которые еще не отправлялись')
+        parser.add_argument('--resend', action='store_true',
+                            help='Новый прогон: отправить всем получателям заново')
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'])
+
+        if options['mailings']:
+            mailings = Mailing.objects.filter(pk__in=options['mailings'])
+        else:
+            mailings = Mailing.objects.filter(status='started').exclude(runs__finished_at__isnull=False)
+
+        with ExitStack() as stack:
+            run_ids = []
+            for mailing in mailings:
+                run = stack.enter_context(mailing_run(mailing, resend=options['resend']))
+                if run is None:
+                    self.stdout.write(self.style.WARNING(f'⏳ {mailing}: уже отправляется, пропущена'))
+                    continue
+                total = enqueue_mailing(mailing, run)
+                run_ids.append(run.pk)
+                self.stdout.write(f'📋 {mailing}: в очереди {total} получателей')
+
+            if not run_ids:
+                self.stdout.write('Нет рассылок для отправки')
+                return
+
+            # Дочерние процессы не должны наследовать открытые соединения с БД
+            connections.close_all()
+
+            shards = [
+                (shard, processes, options['batch_size'], options['lease_seconds'], run_ids)
+                for shard in range(processes)
+            ]
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.starmap(worker_main, shards)
+
+        sent_count = sum(sent for sent, failed in results)
+        failed_count = sum(failed for sent, failed in results)
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ Отправлено: {sent_count}, неудачно: {failed_count} ({processes} процессов)'
+        ))
@@ -0,0 +1,64 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from mailing.smtp_sink import SMTPSink
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальный SMTP-сервер-заглушку для замеров скорости отправки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=1025)
+        parser.add_argument('--latency-ms', type=float, default=0,
+                            help='Задержка ответа на каждое письмо, мс')
+        parser.add_argument('--max-connections', type=int, default=100,
+                            help='Лимит одновременных соединений (сверх него - 421)')
+        parser.add_argument('--max-messages', type=int, default=0,
+                            help='Писем на соединение, после чего сервер его закрывает (0 - без лимита)')
+        parser.add_argument('--tempfail-rate', type=float, default=0,
+                            help='Доля писем с ответом 451 (0..1)')
+        parser.add_argument('--permfail-rate', type=float, default=0,
+                            help='Доля писем с ответом 554 (0..1)')
+        parser.add_argument('--report-interval', type=int, default=5,
+                            help='Период вывода статистики, с')
+
+    def handle(self, *args, **options):
+        sink = SMTPSink(
+            host=options['host'],
+            port=options['port'],
+            latency=options['latency_ms'] / 1000,
+            max_connections=options['max_connections'],
+            max_messages=options['max_messages'],
+            tempfail_rate=options['tempfail_rate'],
+            permfail_rate=options['permfail_rate'],
+        )
+        try:
+            asyncio.run(self.serve(sink, options['report_interval']))
+        except KeyboardInterrupt:
+            pass
+        self.report(sink, final=True)
+
+    async def serve(self, sink, interval):
+        await sink.start_server()
+        self.stdout.write(self.style.SUCCESS(
+            f'📮 SMTP-заглушка слушает {sink.host}:{sink.port} '
+            f'(EMAIL_BACKEND = smtp, EMAIL_HOST = {sink.host}, EMAIL_PORT = {sink.port})'
+        ))
+        previous = 0
+        while True:
+            await asyncio.sleep(interval)
+            accepted = sink.stats.accepted
+            self.stdout.write(f'{(accepted - previous) / interval:.1f} писем/с за интервал')
+            self.report(sink)
+            previous = accepted
+
+    def report(self, sink, final=False):
+        stats = sink.stats
+        style = self.style.SUCCESS if final else (lambda text: text)
+        self.stdout.write(style(
+            f'Принято: {stats.accepted} ({stats.rate():.1f} писем/с), 4xx: {stats.tempfailed}, '
+            f'5xx: {stats.permfailed}, соединений: {stats.connections}, '
+            f'отклонено соединений: {stats.rejected_connections}'
+        ))
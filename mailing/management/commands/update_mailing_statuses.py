@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mailing.services import update_mailing_statuses
+
+
+class Command(BaseCommand):
+    help = 'Обновляет статусы рассылок по времени начала и окончания'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=0,
+            help='Повторять каждые N секунд (0 - выполнить один раз)',
+        )
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+
+        while True:
+            result = update_mailing_statuses()
+            self.stdout.write(self.style.SUCCESS(
+                f"✅ Запущено: {result['started']}, завершено: {result['completed']}, "
+                f"возвращено в «Создана»: {result['created']}"
+            ))
+            if not interval:
+                break
+            time.sleep(interval)
@@ -0,0 +1,249 @@
+"""Метрики приложения в текстовом формате Prometheus.
+
+Значения хранятся в памяти процесса. Метрики с persistent=True (отправка
+писем) процесс прибавляет к общим итогам в БД (MetricTotal) после каждого
+прохода отправки, и /metrics отдает их сумму по всем процессам, включая
+воркеры send_workers.
+
+HTTP-метрики (MetricsMiddleware) не сохраняются: /metrics отдает значения
+только того процесса, который обработал запрос. Они верны при одном
+процессе веб-сервера; при нескольких воркерах gunicorn/uwsgi каждый опрос
+попадает в случайный процесс, и счетчики скачут, в том числе назад.
+"""
+import bisect
+import json
+import logging
+import threading
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+REGISTRY = []
+
+
+def _escape(value):
+    """Экранирование значения метки"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Монотонно растущий счетчик"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), persistent=False):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.persistent = persistent
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def take(self):
+        """Значения процесса с обнулением (приращение для MetricTotal)"""
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    @staticmethod
+    def fields(key, value):
+        yield 'value', value
+
+    @staticmethod
+    def add_field(values, key, field, value):
+        values[key] = values.get(key, 0) + value
+
+    def collect(self, totals=()):
+        """Строки метрики; totals - [(ключ меток, поле, значение)] из MetricTotal"""
+        with self._lock:
+            values = dict(self._values)
+        for key, field, value in totals:
+            self.add_field(values, key, field, value)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, persistent=False):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.persistent = persistent
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [счетчики по корзинам (+Inf последней), сумма, количество]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def take(self):
+        """Значения процесса с обнулением (приращение для MetricTotal)"""
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    @staticmethod
+    def fields(key, state):
+        counts, total, count = state
+        for index, bucket_count in enumerate(counts):
+            yield f'bucket{index}', bucket_count
+        yield 'sum', total
+        yield 'count', count
+
+    def add_field(self, values, key, field, value):
+        state = values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+        if field.startswith('bucket'):
+            index = int(field[len('bucket'):])
+            if index < len(state[0]):
+                state[0][index] += int(value)
+        elif field == 'sum':
+            state[1] += value
+        elif field == 'count':
+            state[2] += int(value)
+
+    def collect(self, totals=()):
+        """Строки метрики; totals - [(ключ меток, поле, значение)] из MetricTotal"""
+        with self._lock:
+            values = {key: [list(state[0]), state[1], state[2]] for key, state in self._values.items()}
+        for key, field, value in totals:
+            self.add_field(values, key, field, value)
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+def persist():
+    """Перенос значений persistent-метрик процесса в общие итоги (MetricTotal).
+
+    Один UPDATE на поле; значения процесса обнуляются, поэтому повторный
+    вызов прибавит только новое. Если запись не удалась, значения
+    возвращаются процессу и уйдут со следующим вызовом.
+    """
+    from .models import MetricTotal
+
+    taken = [(metric, metric.take()) for metric in REGISTRY if metric.persistent]
+    try:
+        with transaction.atomic():
+            for metric, values in taken:
+                for key, state in values.items():
+                    labels = json.dumps(key, ensure_ascii=False)
+                    for field, value in metric.fields(key, state):
+                        if value:
+                            _bump(MetricTotal, metric.name, labels, field, value)
+    except Exception:
+        logger.exception('Не удалось сохранить метрики, повтор при следующей записи')
+        for metric, values in taken:
+            with metric._lock:
+                for key, state in values.items():
+                    for field, value in metric.fields(key, state):
+                        metric.add_field(metric._values, key, field, value)
+
+
+def _bump(model, metric, labels, field, value):
+    lookup = {'metric': metric, 'labels': labels, 'field': field}
+    if model.objects.filter(**lookup).update(value=F('value') + value):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(value=value, **lookup)
+    except IntegrityError:
+        # Строку успел создать параллельный процесс
+        model.objects.filter(**lookup).update(value=F('value') + value)
+
+
+def _totals():
+    """Итоги persistent-метрик из MetricTotal: {метрика: [(ключ меток, поле, значение)]}"""
+    from .models import MetricTotal
+
+    totals = {}
+    for metric, labels, field, value in MetricTotal.objects.values_list('metric', 'labels', 'field', 'value'):
+        totals.setdefault(metric, []).append((tuple(json.loads(labels)), field, value))
+    return totals
+
+
+def render():
+    """Все метрики реестра в формате Prometheus text exposition 0.0.4"""
+    totals = _totals()
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.collect(totals.get(metric.name, ()) if metric.persistent else ()))
+    return '\n'.join(lines) + '\n'
+
+
+# HTTP
+http_requests_total = Counter(
+    'http_requests_total',
+    'Количество HTTP-запросов',
+    ('view', 'method', 'status'),
+)
+http_request_duration_seconds = Histogram(
+    'http_request_duration_seconds',
+    'Время обработки HTTP-запроса',
+    ('view', 'method'),
+)
+db_queries_per_request = Histogram(
+    'db_queries_per_request',
+    'Количество SQL-запросов на один HTTP-запрос',
+    ('view',),
+    buckets=QUERY_COUNT_BUCKETS,
+)
+db_query_duration_seconds_total = Counter(
+    'db_query_duration_seconds_total',
+    'Суммарное время выполнения SQL-запросов',
+    ('view',),
+)
+
+# Отправка рассылок: суммы по всем процессам (MetricTotal)
+mailing_messages_total = Counter(
+    'mailing_messages_total',
+    'Количество отправленных писем по результату',
+    ('status',),
+    persistent=True,
+)
+mailing_smtp_duration_seconds = Histogram(
+    'mailing_smtp_duration_seconds',
+    'Время отправки одного письма через SMTP',
+    persistent=True,
+)
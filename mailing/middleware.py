@@ -0,0 +1,100 @@
+import cProfile
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from . import metrics
+from .profiling import QueryLog, save_profile
+
+
+class QueryCounter:
+    """Обертка для connection.execute_wrapper: считает SQL-запросы и их время"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+class MetricsMiddleware:
+    """Время ответа, количество и время SQL-запросов по имени URL.
+
+    Значения - в памяти процесса (см. mailing.metrics): верны только при
+    одном процессе веб-сервера.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        # Имя URL вместо пути, чтобы не плодить метки на каждый pk
+        match = request.resolver_match
+        view = match.view_name if match and match.view_name else '<unresolved>'
+
+        metrics.http_requests_total.inc(view=view, method=request.method, status=response.status_code)
+        metrics.http_request_duration_seconds.observe(duration, view=view, method=request.method)
+        metrics.db_queries_per_request.observe(queries.count, view=view)
+        metrics.db_query_duration_seconds_total.inc(queries.duration, view=view)
+        return response
+
+
+class ProfilingMiddleware:
+    """Профилирование запроса по заголовку X-Profile / параметру ?_profile
+    (только для суперпользователей) или случайной выборке PROFILING_SAMPLE_RATE.
+
+    При PROFILING_ENABLED = False middleware отключается при старте.
+    """
+
+    HEADER = 'HTTP_X_PROFILE'
+    QUERY_PARAM = '_profile'
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE
+        # cProfile нельзя запускать в нескольких потоках одновременно
+        self.lock = threading.Lock()
+
+    def should_profile(self, request):
+        # Сначала дешевые проверки: request.user загружается лениво
+        if self.HEADER in request.META or self.QUERY_PARAM in request.GET:
+            return request.user.is_superuser
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if not self.should_profile(request) or not self.lock.acquire(blocking=False):
+            return self.get_response(request)
+
+        try:
+            profiler = cProfile.Profile()
+            query_log = QueryLog()
+            start = time.perf_counter()
+            with connection.execute_wrapper(query_log):
+                profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    profiler.disable()
+            duration = time.perf_counter() - start
+            save_profile(request, response, profiler, query_log, duration)
+        finally:
+            self.lock.release()
+        return response
@@ -1,9 +1,44 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Lower
 from django.core.cache import cache
 from django.conf import settings  # ДОБАВЬТЕ ЭТОТ ИМПОРТ
+from django.utils import timezone
 
 
-class Client(models.Model):
+class AliveManager(models.Manager):
+    """Менеджер по умолчанию: скрывает объекты, помеченные на удаление"""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(is_deleted=False)
+
+
+def with_search_key(update_fields, field, key):
+    """update_fields с ключом поиска, если сохраняется поле, из которого он строится"""
+    if update_fields is not None and field in update_fields:
+        return [*update_fields, key]
+    return update_fields
+
+
+class SoftDeleteModel(models.Model):
+    """Мягкое удаление: объект сразу скрывается, а строки с его историей
+    удаляет пачками команда purge_deleted (mailing.purge)."""
+    is_deleted = models.BooleanField(default=False, db_index=True, verbose_name='Удален')
+    deleted_at = models.DateTimeField(null=True, blank=True, verbose_name='Время удаления')
+
+    objects = AliveManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        abstract = True
+
+    def soft_delete(self):
+        self.is_deleted = True
+        self.deleted_at = timezone.now()
+        self.save(update_fields=['is_deleted', 'deleted_at', 'updated_at'])
+
+
+class Client(SoftDeleteModel):
     owner = models.ForeignKey(  # ДОБАВЛЕНО ПОЛЕ
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -12,6 +47,13 @@ class Client(models.Model):
     email = models.EmailField(unique=True, verbose_name='Email')
     full_name = models.CharField(max_length=255, verbose_name='ФИО')
     comment = models.TextField(blank=True, verbose_name='Комментарий')
+    # ФИО в нижнем регистре для префиксного поиска по индексу: LIKE и LOWER()
+    # в SQLite не используют индекс и не понимают кириллицу
+    name_key = models.CharField(max_length=255, blank=True, editable=False)
+    # Комментарий в нижнем регистре для меток сегментов (icontains по той же причине
+    # не находит «Москва» по «москва»)
+    comment_key = models.TextField(blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменен')
 
     class Meta:
         verbose_name = 'Клиент'
@@ -24,12 +66,24 @@ class Client(models.Model):
     def __str__(self):
         return f'{self.full_name} ({self.email})'
 
+    def save(self, *args, **kwargs):
+        self.name_key = self.full_name.lower()
+        self.comment_key = self.comment.lower()
+        kwargs['update_fields'] = with_search_key(kwargs.get('update_fields'), 'full_name', 'name_key')
+        kwargs['update_fields'] = with_search_key(kwargs['update_fields'], 'comment', 'comment_key')
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name = 'Клиент'
         verbose_name_plural = 'Клиенты'
+        indexes = [
+            # Префиксный поиск в автодополнении диапазоном по ключу
+            models.Index(fields=['owner', 'name_key'], name='client_owner_name_idx'),
+            models.Index(F('owner'), Lower('email'), name='client_owner_email_idx'),
+        ]
 
 
-class Message(models.Model):
+class Message(SoftDeleteModel):
     owner = models.ForeignKey(  # ДОБАВЛЕНО ПОЛЕ
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -37,6 +91,8 @@ class Message(models.Model):
     )
     subject = models.CharField(max_length=255, verbose_name='Тема письма')
     body = models.TextField(verbose_name='Тело письма')
+    subject_key = models.CharField(max_length=255, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменено')
 
     class Meta:
         verbose_name = 'Сообщение'
@@ -49,12 +105,70 @@ class Message(models.Model):
     def __str__(self):
         return self.subject
 
+    def save(self, *args, **kwargs):
+        self.subject_key = self.subject.lower()
+        kwargs['update_fields'] = with_search_key(kwargs.get('update_fields'), 'subject', 'subject_key')
+        super().save(*args, **kwargs)
+
+    def soft_delete(self):
+        super().soft_delete()
+        # Рассылки с этим сообщением удалялись бы каскадом - скрываем их тоже
+        Mailing.objects.filter(message=self).update(
+            is_deleted=True,
+            deleted_at=self.deleted_at,
+            updated_at=self.deleted_at,
+        )
+        cache.delete('home_stats')
+
     class Meta:
         verbose_name = 'Сообщение'
         verbose_name_plural = 'Сообщения'
+        indexes = [
+            models.Index(fields=['owner', 'subject_key'], name='message_owner_subject_idx'),
+        ]
+
+
+class Segment(models.Model):
+    """Сегмент аудитории: получатели выбираются фильтрами в момент отправки"""
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        verbose_name='Владелец'
+    )
+    name = models.CharField(max_length=255, verbose_name='Название')
+    email_domain = models.CharField(
+        max_length=255,
+        blank=True,
+        verbose_name='Домен email',
+        help_text='Например, gmail.com'
+    )
+    comment_tags = models.CharField(
+        max_length=255,
+        blank=True,
+        verbose_name='Метки в комментарии',
+        help_text='Через запятую; клиент должен содержать все метки'
+    )
+
+    def __str__(self):
+        return self.name
+
+    def get_clients(self):
+        """Ленивый QuerySet клиентов сегмента (запрос выполняется при итерации)"""
+        clients = Client.objects.filter(owner_id=self.owner_id)
+        if self.email_domain:
+            clients = clients.filter(email__iendswith='@' + self.email_domain.strip().lstrip('@'))
+        for tag in self.comment_tags.split(','):
+            tag = tag.strip().lower()
+            if tag:
+                clients = clients.filter(comment_key__contains=tag)
+        return clients
 
+    class Meta:
+        verbose_name = 'Сегмент'
+        verbose_name_plural = 'Сегменты'
 
-class Mailing(models.Model):
+
+class Mailing(SoftDeleteModel):
     owner = models.ForeignKey(  # ДОБАВЛЕНО ПОЛЕ
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -81,15 +195,56 @@ class Mailing(models.Model):
     )
     clients = models.ManyToManyField(
         Client,
+        blank=True,
         verbose_name='Получатели'
     )
+    segment = models.ForeignKey(
+        Segment,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name='Сегмент'
+    )
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменена')
+    run_lock_until = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name='Отправляется до'
+    )
 
     def __str__(self):
         return f'Рассылка #{self.id} ({self.get_status_display()})'
 
+    def status_at(self, now):
+        """Статус по времени; те же правила применяет update_mailing_statuses"""
+        if self.end_time < now:
+            return 'completed'
+        if self.start_time <= now:
+            return 'started'
+        return 'created'
+
+    def save(self, *args, **kwargs):
+        # Статус новой или измененной рассылки верен сразу, не дожидаясь
+        # периодического update_mailing_statuses
+        update_fields = kwargs.get('update_fields')
+        if self.start_time and self.end_time and (update_fields is None or 'status' in update_fields):
+            self.status = self.status_at(timezone.now())
+        super().save(*args, **kwargs)
+
+    def get_recipients(self):
+        """Получатели: сегмент, если он задан, иначе явно выбранные клиенты"""
+        if self.segment_id:
+            return self.segment.get_clients()
+        return self.clients.all()
+
     class Meta:
         verbose_name = 'Рассылка'
         verbose_name_plural = 'Рассылки'
+        indexes = [
+            # Для фильтрации по статусу и перевода статусов по времени
+            models.Index(fields=['status', 'start_time', 'end_time'], name='mailing_status_window_idx'),
+        ]
 
 
 class MailingAttempt(models.Model):
@@ -133,6 +288,215 @@ class MailingAttempt(models.Model):
         ]
 
 
+class MailingRun(models.Model):
+    """Один прогон отправки рассылки"""
+    mailing = models.ForeignKey(
+        Mailing,
+        on_delete=models.CASCADE,
+        related_name='runs',
+        verbose_name='Рассылка'
+    )
+    triggered_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name='Запустил'
+    )
+    started_at = models.DateTimeField(auto_now_add=True, verbose_name='Начало')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Окончание')
+
+    def __str__(self):
+        return f'Прогон #{self.id} рассылки #{self.mailing_id}'
+
+    class Meta:
+        verbose_name = 'Прогон рассылки'
+        verbose_name_plural = 'Прогоны рассылок'
+
+
+class Delivery(models.Model):
+    """Получатель рассылки в очереди отправки.
+
+    Воркеры захватывают строки арендой (lease_owner, lease_expires_at);
+    аренда упавшего воркера истекает, и строку забирает другой.
+    Домен получателя хранится в строке: воркеры делят очередь по domain_hash
+    и отправляют в каждый домен со своими лимитами (mailing.domains).
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Ожидает'),
+        ('sent', 'Отправлено'),
+        ('failed', 'Ошибка'),
+    ]
+
+    mailing = models.ForeignKey(
+        Mailing,
+        on_delete=models.CASCADE,
+        verbose_name='Рассылка'
+    )
+    client = models.ForeignKey(
+        Client,
+        on_delete=models.CASCADE,
+        verbose_name='Клиент'
+    )
+    run = models.ForeignKey(
+        MailingRun,
+        on_delete=models.CASCADE,
+        verbose_name='Прогон'
+    )
+    domain = models.CharField(max_length=255, blank=True, verbose_name='Домен получателя')
+    domain_hash = models.PositiveIntegerField(default=0, editable=False)
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='pending',
+        verbose_name='Статус'
+    )
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')
+    lease_owner = models.CharField(max_length=100, blank=True, verbose_name='Воркер')
+    lease_expires_at = models.DateTimeField(null=True, blank=True, verbose_name='Аренда до')
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name='Время отправки')
+
+    def __str__(self):
+        return f'Доставка #{self.id} ({self.get_status_display()})'
+
+    class Meta:
+        verbose_name = 'Доставка'
+        verbose_name_plural = 'Доставки'
+        constraints = [
+            # Ключ идемпотентности: одно письмо клиенту за прогон
+            models.UniqueConstraint(fields=['mailing', 'client', 'run'], name='delivery_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'lease_expires_at'], name='delivery_claim_idx'),
+        ]
+
+
+class DeliveryStat(models.Model):
+    """Дневная сводка попыток: день x рассылка x владелец x статус -> количество.
+
+    Поддерживается инкрементально при записи попыток (mailing.stats),
+    отчеты читают только эту таблицу, а не всю историю MailingAttempt.
+    """
+    day = models.DateField(verbose_name='День')
+    mailing = models.ForeignKey(
+        Mailing,
+        on_delete=models.CASCADE,
+        verbose_name='Рассылка'
+    )
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        verbose_name='Владелец'
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=MailingAttempt.STATUS_CHOICES,
+        verbose_name='Статус попытки'
+    )
+    count = models.PositiveIntegerField(default=0, verbose_name='Количество')
+
+    def __str__(self):
+        return f'{self.day} рассылка #{self.mailing_id}: {self.get_status_display()} - {self.count}'
+
+    class Meta:
+        verbose_name = 'Статистика доставки'
+        verbose_name_plural = 'Статистика доставки'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'mailing', 'status'], name='delivery_stat_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', 'day'], name='delivery_stat_owner_day_idx'),
+        ]
+
+
+class TrackingEvent(models.Model):
+    """Открытия и переходы по ссылкам, агрегированные по дням.
+
+    Пишется пачками из буфера mailing.tracking, а не строкой на каждое событие.
+    """
+    KIND_CHOICES = [
+        ('open', 'Открытие'),
+        ('click', 'Переход'),
+    ]
+
+    mailing = models.ForeignKey(
+        Mailing,
+        on_delete=models.CASCADE,
+        verbose_name='Рассылка'
+    )
+    client = models.ForeignKey(
+        Client,
+        on_delete=models.CASCADE,
+        verbose_name='Клиент'
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name='Событие')
+    day = models.DateField(verbose_name='День')
+    count = models.PositiveIntegerField(default=0, verbose_name='Количество')
+    first_seen = models.DateTimeField(verbose_name='Первое')
+    last_seen = models.DateTimeField(verbose_name='Последнее')
+
+    def __str__(self):
+        return f'{self.get_kind_display()}: рассылка #{self.mailing_id}, клиент #{self.client_id}'
+
+    class Meta:
+        verbose_name = 'Событие отслеживания'
+        verbose_name_plural = 'События отслеживания'
+        constraints = [
+            models.UniqueConstraint(fields=['mailing', 'client', 'kind', 'day'], name='tracking_event_unique'),
+        ]
+
+
+class RequestProfile(models.Model):
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Время')
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name='Пользователь'
+    )
+    method = models.CharField(max_length=10, verbose_name='Метод')
+    path = models.CharField(max_length=2048, verbose_name='Путь')
+    view_name = models.CharField(max_length=255, blank=True, verbose_name='Имя URL')
+    status_code = models.PositiveSmallIntegerField(verbose_name='Код ответа')
+    duration_ms = models.FloatField(verbose_name='Длительность, мс')
+    query_count = models.PositiveIntegerField(verbose_name='SQL-запросов')
+    query_time_ms = models.FloatField(verbose_name='Время SQL, мс')
+    profile_file = models.CharField(max_length=1024, verbose_name='Файл профиля')
+    queries_file = models.CharField(max_length=1024, verbose_name='Файл SQL-запросов')
+    summary = models.TextField(blank=True, verbose_name='Самые затратные функции')
+
+    def __str__(self):
+        return f'{self.method} {self.path} ({self.duration_ms:.0f} мс)'
+
+    class Meta:
+        verbose_name = 'Профиль запроса'
+        verbose_name_plural = 'Профили запросов'
+        ordering = ['-created_at']
+
+
+class MetricTotal(models.Model):
+    """Накопленное значение метрики, общее для всех процессов (mailing.metrics).
+
+    Процессы прибавляют сюда свои приращения, /metrics отдает сумму. Поле -
+    value у счетчика; bucket<N>, sum и count у гистограммы.
+    """
+    metric = models.CharField(max_length=100, verbose_name='Метрика')
+    labels = models.CharField(max_length=255, blank=True, verbose_name='Метки (JSON)')
+    field = models.CharField(max_length=20, verbose_name='Поле')
+    value = models.FloatField(default=0, verbose_name='Значение')
+
+    def __str__(self):
+        return f'{self.metric}{self.labels} {self.field} = {self.value}'
+
+    class Meta:
+        verbose_name = 'Значение метрики'
+        verbose_name_plural = 'Значения метрик'
+        constraints = [
+            models.UniqueConstraint(fields=['metric', 'labels', 'field'], name='metric_total_unique'),
+        ]
+
+
 def clear_client_cache(sender, instance, **kwargs):
     """Очистка кеша при изменении клиентов"""
     cache.delete('home_stats')
@@ -143,11 +507,35 @@ def clear_mailing_cache(sender, instance, **kwargs):
     cache.delete('home_stats')
 
 
-from django.db.models.signals import post_save, post_delete
+def touch_client_mailings(sender, instance, **kwargs):
+    """Рассылки клиента считаются измененными: список рассылок показывает число
+    получателей, и его ETag (updated_at) должен смениться"""
+    Mailing.all_objects.filter(clients=instance).update(updated_at=timezone.now())
+
+
+def touch_mailings_on_clients_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """То же при изменении состава получателей (M2M)"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        mailings = Mailing.all_objects.filter(pk=instance.pk)
+    elif action == 'pre_clear':
+        mailings = Mailing.all_objects.filter(clients=instance)
+    else:
+        mailings = Mailing.all_objects.filter(pk__in=pk_set)
+    mailings.update(updated_at=timezone.now())
+
+
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
 
 
 post_save.connect(clear_client_cache, sender=Client)
 post_delete.connect(clear_client_cache, sender=Client)
 
 post_save.connect(clear_mailing_cache, sender=Mailing)
-post_delete.connect(clear_mailing_cache, sender=Mailing)
\ No newline at end of file
+post_delete.connect(clear_mailing_cache, sender=Mailing)
+
+# Связи удаляются каскадом до post_delete, поэтому рассылки клиента ищем в pre_delete
+post_save.connect(touch_client_mailings, sender=Client)
+pre_delete.connect(touch_client_mailings, sender=Client)
+m2m_changed.connect(touch_mailings_on_clients_changed, sender=Mailing.clients.through)
\ No newline at end of file
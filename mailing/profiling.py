@@ -0,0 +1,75 @@
+"""Профилирование отдельных запросов: cProfile + журнал SQL-запросов.
+
+Результат сохраняется в PROFILING_DIR (файл .prof открывается pstats или
+snakeviz, рядом лежит .sql.json), а краткая сводка - в RequestProfile,
+чтобы профили были видны в админке.
+"""
+import io
+import json
+import pstats
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.utils import timezone
+
+
+class QueryLog:
+    """Обертка для connection.execute_wrapper: записывает все SQL-запросы"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'params': repr(params)[:500],
+                'many': many,
+                'duration_ms': (time.perf_counter() - start) * 1000,
+            })
+
+    @property
+    def total_ms(self):
+        return sum(query['duration_ms'] for query in self.queries)
+
+
+def save_profile(request, response, profiler, query_log, duration):
+    """Сохраняет профиль на диск и создает запись RequestProfile"""
+    from .models import RequestProfile
+
+    directory = Path(settings.PROFILING_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    match = request.resolver_match
+    view_name = match.view_name if match and match.view_name else ''
+    stem = f"{timezone.now():%Y%m%d-%H%M%S}-{(view_name or 'request').replace(':', '_')}-{uuid.uuid4().hex[:8]}"
+
+    profile_file = directory / f'{stem}.prof'
+    profiler.dump_stats(profile_file)
+
+    queries_file = directory / f'{stem}.sql.json'
+    with open(queries_file, 'w', encoding='utf-8') as f:
+        json.dump(query_log.queries, f, ensure_ascii=False, indent=1)
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(30)
+
+    user = getattr(request, 'user', None)
+    return RequestProfile.objects.create(
+        user=user if user is not None and user.is_authenticated else None,
+        method=request.method,
+        path=request.get_full_path()[:2048],
+        view_name=view_name,
+        status_code=response.status_code,
+        duration_ms=duration * 1000,
+        query_count=len(query_log.queries),
+        query_time_ms=query_log.total_ms,
+        profile_file=str(profile_file),
+        queries_file=str(queries_file),
+        summary=summary.getvalue(),
+    )
@@ -0,0 +1,99 @@
+"""Фоновое удаление объектов, помеченных is_deleted.
+
+Каскад Django сначала загружает в память все связанные строки, поэтому
+для рассылок с миллионами попыток удаление идет здесь: зависимые таблицы
+чистятся пачками DELETE ... WHERE id IN (SELECT id ... LIMIT n), каждая
+пачка в своей короткой транзакции, чтобы не держать блокировку записи.
+"""
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import search
+from .models import (
+    Client, Delivery, DeliveryStat, Mailing, MailingAttempt, MailingRun, Message, Segment, TrackingEvent,
+)
+
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def delete_in_batches(table, column, value, batch_size, pause=0.0):
+    """Удаляет строки table, где column = value, пачками; возвращает количество"""
+    column = connection.ops.quote_name(column)
+    sql = (
+        f'DELETE FROM {table} WHERE id IN '
+        f'(SELECT id FROM {table} WHERE {column} = %s LIMIT %s)'
+    )
+    total = 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, [value, batch_size])
+            deleted = cursor.rowcount
+        total += deleted
+        if deleted < batch_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def purge_mailing(mailing_id, batch_size, pause=0.0):
+    clients_through = _table(Mailing.clients.through)
+    # Порядок важен: доставки ссылаются на прогоны
+    for table in (_table(Delivery), _table(MailingAttempt), _table(TrackingEvent),
+                  _table(DeliveryStat), _table(MailingRun), clients_through):
+        delete_in_batches(table, 'mailing_id', mailing_id, batch_size, pause)
+    delete_in_batches(_table(Mailing), 'id', mailing_id, 1)
+
+
+def purge_client(client_id, batch_size, pause=0.0):
+    for table in (_table(Delivery), _table(TrackingEvent), _table(Mailing.clients.through)):
+        delete_in_batches(table, 'client_id', client_id, batch_size, pause)
+    delete_in_batches(_table(Client), 'id', client_id, 1)
+    # purge_owner помечает строки через update(), минуя сигналы индекса
+    search.remove(Client, client_id)
+
+
+def purge_message(message_id, batch_size, pause=0.0):
+    # Рассылки с этим сообщением помечены удаленными вместе с ним
+    for mailing_id in Mailing.all_objects.filter(message_id=message_id).values_list('pk', flat=True):
+        purge_mailing(mailing_id, batch_size, pause)
+    delete_in_batches(_table(Message), 'id', message_id, 1)
+    search.remove(Message, message_id)
+
+
+def purge_deleted(batch_size=1000, pause=0.0, owner_id=None):
+    """Удаляет помеченные объекты (owner_id - только этого пользователя).
+
+    Возвращает {модель: количество}.
+    """
+    result = {}
+    for model, purge in ((Mailing, purge_mailing), (Client, purge_client), (Message, purge_message)):
+        objects = model.all_objects.filter(is_deleted=True)
+        if owner_id is not None:
+            objects = objects.filter(owner_id=owner_id)
+        ids = list(objects.values_list('pk', flat=True))
+        for pk in ids:
+            purge(pk, batch_size, pause)
+        result[model._meta.verbose_name_plural] = len(ids)
+    return result
+
+
+def purge_owner(user_id, batch_size=1000, pause=0.0):
+    """Удаляет пользователя со всеми его клиентами, сообщениями и рассылками.
+
+    Помеченные на удаление объекты других пользователей не трогает: их
+    удалит обычный запуск purge_deleted.
+    """
+    now = timezone.now()
+    for model in (Mailing, Client, Message):
+        model.all_objects.filter(owner_id=user_id, is_deleted=False).update(is_deleted=True, deleted_at=now)
+    result = purge_deleted(batch_size, pause, owner_id=user_id)
+
+    # Остаток связанных строк невелик - его удаляет обычный каскад
+    Segment.objects.filter(owner_id=user_id).delete()
+    get_user_model().objects.filter(pk=user_id).delete()
+    return result
@@ -0,0 +1,215 @@
+"""Полнотекстовый поиск по клиентам и сообщениям (SQLite FTS5).
+
+Для каждой модели есть виртуальная таблица FTS5 с копией текстовых полей и
+owner_id; rowid совпадает с pk. Таблицы создаются после migrate (сигнал
+post_migrate) и, для баз без нового migrate, при первом обращении
+(CREATE VIRTUAL TABLE IF NOT EXISTS). Индекс обновляется сигналами
+post_save/post_delete (подключаются в MailingConfig.ready). Объекты,
+созданные в обход сигналов (bulk_create, update), и данные, существовавшие
+до появления поиска, индексирует команда rebuild_search_index.
+
+Каждое слово запроса ищется как префикс, результаты упорядочены по bm25.
+На других СУБД поиск работает через icontains.
+"""
+import re
+from functools import reduce
+from operator import and_, or_
+
+from django.db import connection, connections, transaction
+from django.db.models import Q
+
+from .models import Client, Message
+
+
+def normalize(text):
+    """unicode61 не считает ё вариантом е - приводим сами и в индексе, и в запросе"""
+    return text.replace('ё', 'е').replace('Ё', 'Е')
+
+
+class SearchIndex:
+    def __init__(self, model, fields, weights):
+        self.model = model
+        self.fields = fields
+        # Вес полей в bm25: совпадение в имени важнее совпадения в комментарии
+        self.weights = weights
+        self.table = f'{model._meta.db_table}_fts'
+
+    def create(self, using='default'):
+        columns = ', '.join(self.fields)
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5("
+                f"{columns}, owner_id UNINDEXED, "
+                f"tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+            )
+
+    def _row(self, instance):
+        texts = (normalize(getattr(instance, field) or '') for field in self.fields)
+        return [instance.pk, *texts, instance.owner_id]
+
+    def add(self, instance):
+        placeholders = ', '.join(['%s'] * (len(self.fields) + 2))
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [instance.pk])
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, {", ".join(self.fields)}, owner_id) VALUES ({placeholders})',
+                self._row(instance),
+            )
+
+    def remove(self, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [pk])
+
+    def search_ids(self, terms, owner_id=None, limit=50):
+        """pk найденных объектов, лучшие совпадения первыми"""
+        # Слова запроса - только \w+, поэтому кавычки и операторы FTS5 в них не попадут
+        match = ' '.join(f'"{term}"*' for term in terms)
+        weights = ', '.join(str(weight) for weight in self.weights)
+        sql = f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s'
+        params = [match]
+        if owner_id is not None:
+            sql += ' AND owner_id = %s'
+            params.append(owner_id)
+        sql += f' ORDER BY bm25({self.table}, {weights}) LIMIT %s'
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def rebuild(self, chunk_size=2000):
+        """Полная переиндексация неудаленных объектов, возвращает их количество"""
+        placeholders = ', '.join(['%s'] * (len(self.fields) + 2))
+        insert = f'INSERT INTO {self.table} (rowid, {", ".join(self.fields)}, owner_id) VALUES ({placeholders})'
+        rows = self.model.objects.only('pk', 'owner_id', *self.fields).iterator(chunk_size=chunk_size)
+        total = 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+            batch = []
+            for instance in rows:
+                batch.append(self._row(instance))
+                if len(batch) >= chunk_size:
+                    cursor.executemany(insert, batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                cursor.executemany(insert, batch)
+                total += len(batch)
+            # Слияние сегментов индекса после массовой вставки
+            cursor.execute(f"INSERT INTO {self.table} ({self.table}) VALUES ('optimize')")
+        return total
+
+
+INDEXES = {
+    Client: SearchIndex(Client, ('full_name', 'email', 'comment'), (10.0, 5.0, 1.0)),
+    Message: SearchIndex(Message, ('subject', 'body'), (5.0, 1.0)),
+}
+
+_created = set()
+
+
+def is_available():
+    return connection.vendor == 'sqlite'
+
+
+def create_tables(using='default', **kwargs):
+    """Обработчик post_migrate: таблицы создаются вне транзакций запросов"""
+    if connections[using].vendor != 'sqlite':
+        return
+    for index in INDEXES.values():
+        index.create(using)
+
+
+def get_index(model):
+    """Индекс модели; таблицы создаются один раз на базу данных"""
+    key = connection.settings_dict['NAME']
+    if key not in _created:
+        for index in INDEXES.values():
+            index.create()
+        _created.add(key)
+    return INDEXES[model]
+
+
+def parse_query(query):
+    return re.findall(r'\w+', normalize(query.lower()))
+
+
+def search(model, query, owner=None, limit=50):
+    """Неудаленные объекты модели по запросу, лучшие совпадения первыми.
+
+    owner - ограничить объектами пользователя (None - все).
+    """
+    terms = parse_query(query)
+    if not terms:
+        return []
+    owner_id = getattr(owner, 'pk', owner)
+    objects = model.objects.select_related('owner')
+
+    if not is_available():
+        fields = INDEXES[model].fields
+        condition = reduce(and_, (
+            reduce(or_, (Q(**{f'{field}__icontains': term}) for field in fields))
+            for term in terms
+        ))
+        if owner_id is not None:
+            objects = objects.filter(owner_id=owner_id)
+        return list(objects.filter(condition).order_by('pk')[:limit])
+
+    ids = get_index(model).search_ids(terms, owner_id, limit)
+    # Помеченные удаленными отсеет менеджер objects
+    found = objects.in_bulk(ids)
+    return [found[pk] for pk in ids if pk in found]
+
+
+def search_ids(model, query, limit=1000):
+    """pk объектов по запросу без учета владельца (для админки)"""
+    terms = parse_query(query)
+    if not terms:
+        return []
+    return get_index(model).search_ids(terms, limit=limit)
+
+
+def rebuild(model, chunk_size=2000):
+    return get_index(model).rebuild(chunk_size)
+
+
+SEARCH_KEYS = {
+    Client: (('full_name', 'name_key'), ('comment', 'comment_key')),
+    Message: (('subject', 'subject_key'),),
+}
+
+
+def fill_search_keys(model, chunk_size=2000):
+    """Ключи поиска в нижнем регистре (Client.name_key, Client.comment_key,
+    Message.subject_key) для строк, сохраненных в обход save(); возвращает
+    количество обновленных"""
+    total = 0
+    for field, key in SEARCH_KEYS[model]:
+        missing = model.all_objects.filter(**{key: ''}).exclude(**{field: ''}).only('pk', field)
+        while True:
+            batch = list(missing[:chunk_size])
+            if not batch:
+                break
+            for instance in batch:
+                setattr(instance, key, getattr(instance, field).lower())
+            model.all_objects.bulk_update(batch, [key])
+            total += len(batch)
+    return total
+
+
+def remove(model, pk):
+    if is_available():
+        get_index(model).remove(pk)
+
+
+# Сигналы
+def index_instance(sender, instance, **kwargs):
+    if not is_available():
+        return
+    if instance.is_deleted:
+        get_index(sender).remove(instance.pk)
+    else:
+        get_index(sender).add(instance)
+
+
+def unindex_instance(sender, instance, **kwargs):
+    remove(sender, instance.pk)
@@ -0,0 +1,487 @@
+import os
+import smtplib
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import get_connection, send_mail
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import metrics
+from .domains import DomainDispatcher, domain_hash, email_domain
+from .models import Delivery, Mailing, MailingAttempt, MailingRun
+from .stats import bump_delivery_stats
+from .tracking import render_html, tracking_base_url
+
+
+def update_mailing_statuses(now=None):
+    """Перевод рассылок между статусами по времени начала/окончания.
+
+    Нужен только для переходов, наступивших со временем: при сохранении
+    статус вычисляет Mailing.save(). Каждый переход - один UPDATE по индексу
+    (status, start_time, end_time), поэтому число запросов не зависит от
+    количества рассылок.
+    """
+    now = now or timezone.now()
+
+    with transaction.atomic():
+        completed = Mailing.objects.filter(
+            status__in=['created', 'started'],
+            end_time__lt=now,
+        ).update(status='completed', updated_at=now)
+        started = Mailing.objects.filter(
+            status__in=['created', 'completed'],
+            start_time__lte=now,
+            end_time__gte=now,
+        ).update(status='started', updated_at=now)
+        # Рассылки, время которых перенесли в будущее
+        created = Mailing.objects.filter(
+            status__in=['started', 'completed'],
+            start_time__gt=now,
+        ).update(status='created', updated_at=now)
+
+    if completed or started or created:
+        # update() не отправляет сигналы post_save и не трогает auto_now, поэтому
+        # updated_at задан явно, а кеш чистим сами
+        cache.delete('home_stats')
+
+    return {'started': started, 'completed': completed, 'created': created}
+
+
+def is_permanent_failure(error):
+    """Ошибка 5xx: сервер отверг письмо окончательно, повтор не поможет"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+def deliver_message(message, email, connection=None, tracking=None):
+    """Отправка одного письма.
+
+    Возвращает (статус попытки, ответ сервера, ошибка постоянная (5xx)).
+
+    tracking - (mailing_id, client_id): добавляет HTML-версию с пикселем
+    открытия и отслеживаемыми ссылками, если включен TRACKING_ENABLED.
+    """
+    html_message = None
+    if tracking and settings.TRACKING_ENABLED:
+        html_message = render_html(message.body, *tracking)
+
+    started = time.perf_counter()
+    try:
+        send_mail(
+            subject=message.subject,
+            message=message.body,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            recipient_list=[email],
+            fail_silently=False,
+            connection=connection,
+            html_message=html_message,
+        )
+        status, server_response, permanent = 'success', f'Успешно отправлено клиенту {email}', False
+    except Exception as e:
+        status, server_response, permanent = 'failed', f'Ошибка: {str(e)}', is_permanent_failure(e)
+
+    metrics.mailing_smtp_duration_seconds.observe(time.perf_counter() - started)
+    metrics.mailing_messages_total.inc(status=status)
+    return status, server_response, permanent
+
+
+# ЗАПУСК РАССЫЛКИ
+@contextmanager
+def mailing_run(mailing, user=None, resend=False):
+    """Блокировка рассылки на время прогона.
+
+    Выдает MailingRun или None, если рассылку уже отправляет кто-то другой.
+    Незавершенный прогон (например, после падения) продолжается, а не
+    начинается заново. Повторный запуск в том же окне рассылки тоже
+    продолжает последний прогон: письма получат только новые получатели.
+    Новый прогон (всем заново) - только при resend=True или после переноса
+    рассылки на новое время.
+    """
+    now = timezone.now()
+    lock_until = now + timedelta(seconds=settings.MAILING_RUN_LOCK_TIMEOUT)
+    acquired = Mailing.objects.filter(
+        Q(run_lock_until__isnull=True) | Q(run_lock_until__lt=now),
+        pk=mailing.pk,
+    ).update(run_lock_until=lock_until)
+    if not acquired:
+        yield None
+        return
+
+    try:
+        runs = MailingRun.objects.filter(mailing=mailing).order_by('-pk')
+        run = runs.filter(finished_at__isnull=True).first()
+        if run is None and not resend:
+            run = runs.filter(started_at__gte=mailing.start_time).first()
+        if run is None:
+            run = MailingRun.objects.create(mailing=mailing, triggered_by=user)
+        yield run
+
+        # Доставки, исчерпавшие попытки в упавших воркерах, больше не отправятся
+        Delivery.objects.filter(
+            run=run,
+            status='pending',
+            attempts__gte=settings.MAILING_DELIVERY_MAX_ATTEMPTS,
+        ).update(status='failed', lease_expires_at=None)
+        if not Delivery.objects.filter(run=run, status='pending').exists():
+            MailingRun.objects.filter(pk=run.pk, finished_at__isnull=True).update(finished_at=timezone.now())
+    finally:
+        # Снимаем только свою блокировку: по таймауту ее мог перехватить другой прогон
+        Mailing.objects.filter(pk=mailing.pk, run_lock_until=lock_until).update(run_lock_until=None)
+
+
+def send_mailing(mailing, user=None, resend=False):
+    """Отправка рассылки в текущем процессе.
+
+    Возвращает None, если рассылка уже выполняется, иначе количество
+    получателей (отправлено, не доставлено, ждут повтора). Получатели с
+    временной ошибкой отправляются при следующем запуске, после паузы
+    MAILING_DELIVERY_RETRY_DELAY. (0, 0, 0) - всем получателям письмо уже
+    отправлено в этом окне рассылки.
+    """
+    with mailing_run(mailing, user, resend) as run:
+        if run is None:
+            return None
+        enqueue_mailing(mailing, run)
+        sent, failed = run_delivery_worker(
+            shard=0,
+            shards=1,
+            batch_size=settings.MAILING_SEND_CHUNK_SIZE,
+            lease_seconds=settings.MAILING_RUN_LOCK_TIMEOUT,
+            run_ids=[run.pk],
+        )
+        return sent, failed, Delivery.objects.filter(run=run, status='pending').count()
+
+
+# ОЧЕРЕДЬ ОТПРАВКИ
+def enqueue_mailing(mailing, run, chunk_size=None):
+    """Ставит получателей рассылки в очередь Delivery.
+
+    Уже поставленные в этот прогон получатели пропускаются (ключ
+    mailing + client + run), поэтому повторный вызов безопасен. Получатели
+    читаются пачками через iterator(), память не растет с размером сегмента.
+    """
+    chunk_size = chunk_size or settings.MAILING_SEND_CHUNK_SIZE
+    recipients = mailing.get_recipients().order_by('pk').values_list('pk', 'email')
+    batch = []
+    total = 0
+
+    for client_id, email in recipients.iterator(chunk_size=chunk_size):
+        domain = email_domain(email)
+        batch.append(Delivery(
+            mailing=mailing,
+            client_id=client_id,
+            run=run,
+            domain=domain,
+            domain_hash=domain_hash(domain),
+        ))
+        if len(batch) >= chunk_size:
+            Delivery.objects.bulk_create(batch, ignore_conflicts=True)
+            total += len(batch)
+            batch = []
+    if batch:
+        Delivery.objects.bulk_create(batch, ignore_conflicts=True)
+        total += len(batch)
+
+    return total
+
+
+def _pending(shard, shards, run_ids=None):
+    """Ожидающие доставки шарда.
+
+    Шард - остаток от деления хеша домена: каждый домен целиком отправляет
+    один воркер, и лимиты домена соблюдаются при любом числе процессов.
+    """
+    deliveries = Delivery.objects.filter(
+        status='pending',
+        mailing__is_deleted=False,
+        client__is_deleted=False,
+    )
+    if run_ids is not None:
+        deliveries = deliveries.filter(run_id__in=run_ids)
+    return deliveries.annotate(shard=F('domain_hash') % shards).filter(shard=shard)
+
+
+def _claimable(shard, shards, run_ids=None, now=None):
+    """Ожидающие доставки шарда без действующей аренды"""
+    now = now or timezone.now()
+    free = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now)
+    return _pending(shard, shards, run_ids).filter(free, attempts__lt=settings.MAILING_DELIVERY_MAX_ATTEMPTS)
+
+
+def claim_deliveries(worker_id, shard, shards, batch_size, lease_seconds, run_ids=None,
+                     exclude_domains=(), domain_quota=None):
+    """Захват пачки доставок арендой.
+
+    Кандидаты всех доменов выбираются одним запросом; domain_quota(domain) -
+    сколько строк домена можно взять сейчас (None - без ограничения).
+    Условный UPDATE атомарен и в SQLite: строку получает только тот воркер,
+    чей UPDATE первым застал ее без действующей аренды.
+    """
+    now = timezone.now()
+    free = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now)
+    candidates = _claimable(shard, shards, run_ids, now)
+    if exclude_domains:
+        candidates = candidates.exclude(domain__in=exclude_domains)
+    rows = candidates.order_by('pk').values_list('pk', 'domain')[:batch_size]
+
+    taken = Counter()
+    pks = []
+    for pk, domain in rows:
+        if domain_quota is not None and taken[domain] >= domain_quota(domain):
+            continue
+        taken[domain] += 1
+        pks.append(pk)
+    if not pks:
+        return []
+
+    Delivery.objects.filter(free, pk__in=pks, status='pending').update(
+        lease_owner=worker_id,
+        lease_expires_at=now + timedelta(seconds=lease_seconds),
+        attempts=F('attempts') + 1,
+    )
+
+    return list(
+        Delivery.objects.filter(pk__in=pks, lease_owner=worker_id, lease_expires_at__gt=now)
+        .select_related('client', 'mailing__message')
+    )
+
+
+def renew_leases(deliveries, worker_id, lease_seconds):
+    """Продление аренды взятых в работу доставок, возвращает число продленных.
+
+    Истекшую аренду не продлеваем: строку мог уже забрать другой воркер.
+    """
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=lease_seconds)
+    pks = [delivery.pk for delivery in deliveries]
+    renewed = Delivery.objects.filter(
+        pk__in=pks, lease_owner=worker_id, status='pending', lease_expires_at__gt=now,
+    ).update(lease_expires_at=expires_at)
+    for delivery in deliveries:
+        if delivery.lease_expires_at > now:
+            delivery.lease_expires_at = expires_at
+    return renewed
+
+
+def release_deliveries(deliveries, worker_id):
+    """Возврат в очередь доставок, взятых, но не отправленных.
+
+    Захват увеличил attempts; попытки не было, поэтому счетчик возвращается
+    назад, иначе строка стала бы failed, так и не уйдя получателю.
+    """
+    return Delivery.objects.filter(
+        pk__in=[delivery.pk for delivery in deliveries], lease_owner=worker_id, status='pending',
+    ).update(attempts=F('attempts') - 1, lease_owner='', lease_expires_at=None)
+
+
+def _send_delivery(delivery, connection):
+    """Отправка одной доставки; None - аренда истекла, строку мог забрать другой воркер"""
+    if delivery.lease_expires_at <= timezone.now():
+        return None
+    return deliver_message(
+        delivery.mailing.message,
+        delivery.client.email,
+        connection,
+        tracking=(delivery.mailing_id, delivery.client_id),
+    )
+
+
+def retry_delay(attempts):
+    """Пауза перед повтором после attempts неудачных попыток (удваивается)"""
+    return timedelta(seconds=settings.MAILING_DELIVERY_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def record_deliveries(results, worker_id):
+    """Запись результатов отправки [(доставка, (статус, ответ, постоянная ошибка))].
+
+    Возвращает (отправлено, не доставлено) - по получателям, а не по
+    попыткам. Строка с временной ошибкой остается в очереди, но без
+    владельца и с арендой до времени повтора (retry_delay): ее не возьмет
+    ни один воркер, пока пауза не пройдет. Постоянная ошибка (5xx) и
+    исчерпанные попытки - окончательный failed.
+    """
+    attempts = []
+    sent = []
+    failed = []
+    retry = {}
+    stats = Counter()
+
+    for delivery, (status, server_response, permanent) in results:
+        if status == 'success':
+            sent.append(delivery.pk)
+        elif permanent or delivery.attempts >= settings.MAILING_DELIVERY_MAX_ATTEMPTS:
+            failed.append(delivery.pk)
+        else:
+            retry.setdefault(delivery.attempts, []).append(delivery.pk)
+        stats[delivery.mailing_id, delivery.mailing.owner_id, status] += 1
+        attempts.append(MailingAttempt(
+            mailing_id=delivery.mailing_id,
+            status=status,
+            server_response=server_response,
+        ))
+
+    now = timezone.now()
+    with transaction.atomic():
+        MailingAttempt.objects.bulk_create(attempts)
+        bump_delivery_stats(stats, timezone.localdate(now))
+        # Только свои строки: если аренда истекла и строку забрали, не трогаем ее
+        owned = Delivery.objects.filter(lease_owner=worker_id)
+        owned.filter(pk__in=sent).update(status='sent', sent_at=now, lease_expires_at=None)
+        owned.filter(pk__in=failed).update(status='failed', lease_expires_at=None)
+        for attempt, pks in retry.items():
+            owned.filter(pk__in=pks).update(lease_owner='', lease_expires_at=now + retry_delay(attempt))
+
+    return len(sent), len(failed)
+
+
+def _refill(dispatcher, worker_id, shard, shards, lease_seconds, run_ids, batch_size):
+    """Захват новых доставок, пока пул успевает отправить их до конца аренды.
+
+    Запас - половина аренды: оценка времени отправки может отставать от
+    сервера, а взятое сверх нее истекло бы в очереди.
+    """
+    horizon = lease_seconds / 2
+    full = set()
+    # Несколько раундов: первый запрос может почти целиком прийтись на заполненные домены
+    for _ in range(3):
+        free = dispatcher.capacity(horizon) - dispatcher.outstanding()
+        if free <= 0:
+            return
+        full.update(
+            domain for domain in dispatcher.limits
+            if dispatcher.outstanding(domain) >= dispatcher.domain_capacity(domain, horizon, batch_size)
+        )
+
+        def quota(domain):
+            return dispatcher.domain_capacity(domain, horizon, batch_size) - dispatcher.outstanding(domain)
+
+        deliveries = claim_deliveries(
+            worker_id, shard, shards, min(free, batch_size), lease_seconds, run_ids,
+            exclude_domains=full, domain_quota=quota,
+        )
+        if not deliveries:
+            return
+        by_domain = {}
+        for delivery in deliveries:
+            by_domain.setdefault(delivery.domain, []).append(delivery)
+        for domain, items in by_domain.items():
+            dispatcher.add(domain, items)
+
+
+def run_delivery_worker(shard, shards, batch_size, lease_seconds, run_ids=None):
+    """Цикл воркера: отправка доставок своего шарда, пока они есть.
+
+    Письма уходят из пула потоков (MAILING_SEND_THREADS) с лимитами по
+    доменам; захват строк и запись результатов - в текущем потоке.
+    """
+    if settings.TRACKING_ENABLED:
+        # Ошибку настройки - до захвата строк, а не в каждом потоке отправки
+        tracking_base_url()
+    worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    sent_count = 0
+    failed_count = 0
+
+    # Одно SMTP-соединение на поток пула, а не на каждое письмо
+    local = threading.local()
+    smtp_connections = []
+
+    def drop_connection(connection):
+        local.connection = None
+        if connection in smtp_connections:
+            smtp_connections.remove(connection)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def send(delivery):
+        connection = getattr(local, 'connection', None)
+        if connection is None:
+            connection = get_connection()
+            try:
+                connection.open()
+            except Exception:
+                # Соединение откроется при отправке, ошибка запишется как неудачная попытка
+                pass
+            else:
+                local.connection = connection
+                smtp_connections.append(connection)
+        result = _send_delivery(delivery, connection)
+        if result is not None and result[0] == 'failed':
+            # EmailBackend не переподключается сам: если сервер закрыл соединение
+            # (таймаут простоя, лимит писем на соединение), все следующие письма
+            # потока упали бы. Следующая отправка откроет новое соединение
+            drop_connection(connection)
+        return result
+
+    dispatcher = DomainDispatcher(send, settings.MAILING_SEND_THREADS)
+    results = []
+    skipped = []
+    # Продление аренды - несколько раз за ее срок, чтобы не истекла в очереди
+    tick = min(1.0, lease_seconds / 3)
+    tick_at = 0.0
+    renew_at = time.monotonic() + lease_seconds / 3
+
+    def take(completed):
+        for delivery, result in completed:
+            if result is None:
+                # Аренда истекла до отправки - строку вернем в очередь
+                skipped.append(delivery)
+            else:
+                results.append((delivery, result))
+
+    def record():
+        nonlocal results, skipped, sent_count, failed_count
+        if results:
+            sent, failed = record_deliveries(results, worker_id)
+            sent_count += sent
+            failed_count += failed
+            results = []
+        if skipped:
+            release_deliveries(skipped, worker_id)
+            skipped = []
+
+    try:
+        while True:
+            # По таймеру: запись результатов, продление аренды и новые строки
+            if time.monotonic() >= tick_at or not dispatcher.pending():
+                record()
+                if time.monotonic() >= renew_at:
+                    renew_leases(list(dispatcher.held()), worker_id, lease_seconds)
+                    renew_at = time.monotonic() + lease_seconds / 3
+                _refill(dispatcher, worker_id, shard, shards, lease_seconds, run_ids, batch_size)
+                tick_at = time.monotonic() + tick
+
+            if not dispatcher.pending():
+                # Строки без владельца ждут повтора после ошибки - их отправит следующий запуск
+                leased = _pending(shard, shards, run_ids).filter(lease_expires_at__gte=timezone.now())
+                if not leased.exclude(lease_owner='').exists():
+                    break
+                # Строки шарда арендованы другим (возможно, упавшим) воркером - ждем истечения
+                time.sleep(tick)
+                continue
+
+            take(dispatcher.collect(timeout=tick))
+    finally:
+        completed, leftovers = dispatcher.close()
+        take(completed)
+        # Не начатые из-за остановки - тоже в очередь, без потраченной попытки
+        skipped.extend(leftovers)
+        record()
+        # Счетчики отправки - в общие итоги: процесс-воркер завершится, а /metrics
+        # отдает другой процесс
+        metrics.persist()
+        for connection in smtp_connections:
+            connection.close()
+
+    return sent_count, failed_count
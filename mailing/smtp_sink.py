@@ -0,0 +1,161 @@
+"""Локальный SMTP-сервер-заглушка для нагрузочного тестирования отправки.
+
+Письма принимаются и отбрасываются. Можно задать задержку на письмо,
+лимит одновременных соединений, лимит писем на соединение (после него
+сервер закрывает соединение) и долю ответов 4xx/5xx. Используется из
+команды smtp_sink или как фикстура:
+
+    with SMTPSink(latency=0.05, tempfail_rate=0.1) as sink:
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                               EMAIL_HOST=sink.host, EMAIL_PORT=sink.port):
+            ...
+"""
+import asyncio
+import random
+import threading
+import time
+
+
+class SinkStats:
+    """Счетчики сервера"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.accepted = 0
+        self.tempfailed = 0
+        self.permfailed = 0
+        self.connections = 0
+        self.rejected_connections = 0
+
+    def rate(self):
+        """Принятых писем в секунду с момента запуска"""
+        elapsed = time.monotonic() - self.started_at
+        return self.accepted / elapsed if elapsed > 0 else 0.0
+
+
+class SMTPSink:
+    def __init__(self, host='127.0.0.1', port=1025, latency=0.0, max_connections=100,
+                 tempfail_rate=0.0, permfail_rate=0.0, max_messages=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.max_connections = max_connections
+        # 0 - без ограничения
+        self.max_messages = max_messages
+        self.tempfail_rate = tempfail_rate
+        self.permfail_rate = permfail_rate
+        self.stats = SinkStats()
+        self._active = 0
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    async def _handle(self, reader, writer):
+        if self._active >= self.max_connections:
+            self.stats.rejected_connections += 1
+            writer.write(b'421 4.7.0 Too many connections\r\n')
+            await writer.drain()
+            writer.close()
+            return
+
+        self._active += 1
+        self.stats.connections += 1
+        received = 0
+        try:
+            writer.write(b'220 smtp-sink ESMTP\r\n')
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    writer.write(b'250-smtp-sink\r\n250-PIPELINING\r\n250 8BITMIME\r\n')
+                elif command == b'DATA':
+                    writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                    await writer.drain()
+                    while (await reader.readline()) not in (b'.\r\n', b'.\n', b''):
+                        pass
+                    writer.write(await self._reply())
+                    received += 1
+                    if received == self.max_messages:
+                        # Как почтовый сервер с лимитом писем: закрываем без QUIT
+                        await writer.drain()
+                        break
+                elif command == b'QUIT':
+                    writer.write(b'221 Bye\r\n')
+                    await writer.drain()
+                    break
+                elif command in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                    writer.write(b'250 OK\r\n')
+                else:
+                    writer.write(b'502 Command not implemented\r\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._active -= 1
+            writer.close()
+
+    async def _reply(self):
+        """Ответ на письмо с учетом задержки и внесенных ошибок"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        roll = random.random()
+        if roll < self.tempfail_rate:
+            self.stats.tempfailed += 1
+            return b'451 4.3.0 Temporary failure, try again later\r\n'
+        if roll < self.tempfail_rate + self.permfail_rate:
+            self.stats.permfailed += 1
+            return b'554 5.7.1 Message rejected\r\n'
+        self.stats.accepted += 1
+        return b'250 OK: queued\r\n'
+
+    async def start_server(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # port=0 - свободный порт выбирает система
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.stats = SinkStats()
+        return self._server
+
+    # Запуск в фоновом потоке (для тестов)
+    def start(self, timeout=10):
+        ready = threading.Event()
+        error = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self.start_server())
+            except BaseException as e:
+                # Например, порт занят: ошибку поднимет start() в вызывающем потоке
+                error.append(e)
+                loop.close()
+                ready.set()
+                return
+            self._loop = loop
+            ready.set()
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='smtp-sink', daemon=True)
+        self._thread.start()
+        if not ready.wait(timeout):
+            raise TimeoutError(f'SMTP-заглушка не запустилась за {timeout} с')
+        if error:
+            self._thread.join()
+            raise error[0]
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,107 @@
+// Автодополнение для полей выбора с атрибутом data-autocomplete-url.
+// Сервер рендерит только выбранные варианты, остальные ищутся по мере ввода.
+(function () {
+    'use strict';
+
+    var DEBOUNCE_MS = 250;
+
+    function setup(select) {
+        var url = select.dataset.autocompleteUrl;
+        // Тот же порог, что у сервера (AUTOCOMPLETE_MIN_LENGTH)
+        var minLength = parseInt(select.dataset.autocompleteMinLength, 10) || 1;
+        var input = document.createElement('input');
+        var results = document.createElement('ul');
+        var timer = null;
+        var controller = null;
+
+        input.type = 'text';
+        input.className = select.className;
+        input.placeholder = 'Начните вводить для поиска...';
+        input.autocomplete = 'off';
+        results.className = 'autocomplete-results';
+        select.parentNode.insertBefore(input, select);
+        select.parentNode.insertBefore(results, select);
+
+        if (select.multiple) {
+            select.title = 'Двойной щелчок убирает получателя из списка';
+            select.addEventListener('dblclick', function (event) {
+                if (event.target.tagName === 'OPTION') {
+                    event.target.remove();
+                }
+            });
+        }
+
+        function choose(item) {
+            var option = select.querySelector('option[value="' + item.id + '"]');
+            if (!select.multiple) {
+                select.innerHTML = '';
+                option = null;
+            }
+            if (!option) {
+                option = new Option(item.text, item.id);
+                select.appendChild(option);
+            }
+            option.selected = true;
+            results.innerHTML = '';
+            input.value = '';
+        }
+
+        function render(items) {
+            results.innerHTML = '';
+            items.forEach(function (item) {
+                var li = document.createElement('li');
+                li.textContent = item.text;
+                li.addEventListener('mousedown', function (event) {
+                    event.preventDefault();
+                    choose(item);
+                });
+                results.appendChild(li);
+            });
+        }
+
+        function search(term) {
+            if (controller) {
+                controller.abort();
+            }
+            controller = new AbortController();
+            fetch(url + '?q=' + encodeURIComponent(term), {
+                credentials: 'same-origin',
+                signal: controller.signal
+            })
+                .then(function (response) { return response.json(); })
+                .then(function (data) { render(data.results); })
+                .catch(function (error) {
+                    if (error.name !== 'AbortError') {
+                        results.innerHTML = '';
+                    }
+                });
+        }
+
+        input.addEventListener('input', function () {
+            var term = input.value.trim();
+            clearTimeout(timer);
+            if (term.length < minLength) {
+                results.innerHTML = '';
+                return;
+            }
+            timer = setTimeout(function () { search(term); }, DEBOUNCE_MS);
+        });
+
+        input.addEventListener('blur', function () {
+            results.innerHTML = '';
+        });
+
+        // Выбранные варианты должны уйти на сервер вместе с формой
+        if (select.form) {
+            select.form.addEventListener('submit', function () {
+                Array.prototype.forEach.call(select.options, function (option) {
+                    option.selected = true;
+                });
+            });
+        }
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        document.querySelectorAll('select[data-autocomplete-url]').forEach(setup);
+    });
+})();
@@ -0,0 +1,99 @@
+"""Сводная статистика доставки (DeliveryStat) и отчеты по ней."""
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import DeliveryStat, MailingAttempt
+
+
+def bump_delivery_stats(counts, day=None):
+    """Прибавляет количества попыток к сводке.
+
+    counts: {(mailing_id, owner_id, status): количество}. Один UPDATE на ключ,
+    ключей в пачке - по числу рассылок, а не по числу писем.
+    """
+    day = day or timezone.localdate()
+    for (mailing_id, owner_id, status), count in counts.items():
+        lookup = {'day': day, 'mailing_id': mailing_id, 'status': status}
+        if DeliveryStat.objects.filter(**lookup).update(count=F('count') + count):
+            continue
+        try:
+            with transaction.atomic():
+                DeliveryStat.objects.create(owner_id=owner_id, count=count, **lookup)
+        except IntegrityError:
+            # Строку успел создать параллельный воркер
+            DeliveryStat.objects.filter(**lookup).update(count=F('count') + count)
+
+
+def rebuild_delivery_stats(since=None):
+    """Пересчет сводки из MailingAttempt начиная с дня since (или целиком).
+
+    Возвращает количество строк сводки.
+    """
+    attempts = MailingAttempt.objects.all()
+    stats = DeliveryStat.objects.all()
+    if since is not None:
+        attempts = attempts.filter(attempt_time__date__gte=since)
+        stats = stats.filter(day__gte=since)
+
+    rows = (
+        attempts.annotate(day=TruncDate('attempt_time'))
+        .values('day', 'mailing_id', 'mailing__owner_id', 'status')
+        .annotate(total=Count('pk'))
+        .order_by()
+    )
+    with transaction.atomic():
+        stats.delete()
+        created = DeliveryStat.objects.bulk_create(
+            [
+                DeliveryStat(
+                    day=row['day'],
+                    mailing_id=row['mailing_id'],
+                    owner_id=row['mailing__owner_id'],
+                    status=row['status'],
+                    count=row['total'],
+                )
+                for row in rows.iterator()
+            ],
+            batch_size=1000,
+        )
+    return len(created)
+
+
+def _totals(queryset):
+    """Аннотации успешных/неудачных попыток для values()-запроса"""
+    return queryset.annotate(
+        success=Sum('count', filter=Q(status='success'), default=0),
+        failed=Sum('count', filter=Q(status='failed'), default=0),
+    )
+
+
+def _rate(success, failed):
+    total = success + failed
+    return round(success * 100 / total, 1) if total else None
+
+
+def delivery_report(stats, days):
+    """Отчет за последние days дней по строкам сводки stats.
+
+    Возвращает {'days': [...], 'mailings': [...]} - по дням и по рассылкам
+    с долей успешных попыток в процентах.
+    """
+    since = timezone.localdate() - timedelta(days=days - 1)
+    stats = stats.filter(day__gte=since)
+
+    by_day = [
+        {'day': row['day'].isoformat(), 'success': row['success'], 'failed': row['failed'],
+         'success_rate': _rate(row['success'], row['failed'])}
+        for row in _totals(stats.values('day')).order_by('day')
+    ]
+    by_mailing = [
+        {'mailing': row['mailing_id'], 'owner': row['owner__username'],
+         'success': row['success'], 'failed': row['failed'],
+         'success_rate': _rate(row['success'], row['failed'])}
+        for row in _totals(stats.values('mailing_id', 'owner__username')).order_by('mailing_id')
+    ]
+    return {'since': since.isoformat(), 'days': by_day, 'mailings': by_mailing}
@@ -1,3 +1,800 @@
-from django.test import TestCase
+import re
+import smtplib
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.messages import get_messages
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.mail import get_connection, send_mail
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import DatabaseError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import metrics, search, services, tracking
+from .admin import MailingAdmin
+from .auth_backends import user_cache_key
+from .domains import DomainDispatcher
+from .forms import MailingForm
+from .middleware import ProfilingMiddleware
+from .models import (
+    Client, Delivery, DeliveryStat, Mailing, MailingAttempt, MailingRun, Message, MetricTotal, RequestProfile,
+    Segment, TrackingEvent,
+)
+from .purge import purge_client, purge_mailing, purge_message, purge_owner
+from .services import (
+    _pending, claim_deliveries, enqueue_mailing, mailing_run, record_deliveries, release_deliveries,
+    run_delivery_worker, send_mailing,
+)
+from .smtp_sink import SMTPSink
+from .stats import rebuild_delivery_stats
+
+
+def make_mailing(owner, clients=(), start=timedelta(minutes=-1), end=timedelta(hours=1)):
+    """Рассылка с окном [now + start, now + end] и заданными получателями"""
+    now = timezone.now()
+    message = Message.objects.create(owner=owner, subject='Тема', body='Текст')
+    mailing = Mailing.objects.create(owner=owner, message=message, start_time=now + start, end_time=now + end)
+    mailing.clients.set(clients)
+    return mailing
+
+
+def make_clients(owner, count, domains=('example.com',)):
+    Client.objects.bulk_create([
+        Client(owner=owner, email=f'client{i}@{domains[i % len(domains)]}', full_name=f'Клиент {i}')
+        for i in range(count)
+    ])
+    return list(Client.objects.filter(owner=owner).order_by('pk'))
+
+
+class MailingStatusTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='owner')
+
+    def test_status_set_on_create(self):
+        self.assertEqual(make_mailing(self.user).status, 'started')
+        self.assertEqual(make_mailing(self.user, start=timedelta(hours=1), end=timedelta(hours=2)).status, 'created')
+        self.assertEqual(make_mailing(self.user, start=timedelta(hours=-2), end=timedelta(hours=-1)).status,
+                         'completed')
+
+    def test_status_updated_on_edit(self):
+        mailing = make_mailing(self.user)
+        mailing.end_time = timezone.now() - timedelta(seconds=1)
+        mailing.save()
+        self.assertEqual(Mailing.objects.get(pk=mailing.pk).status, 'completed')
+
+
+class AutocompleteTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create(username='owner')
+        self.other = User.objects.create(username='other')
+        Client.objects.create(owner=self.user, email='Ivan@example.com', full_name='Иван Петров')
+        Client.objects.create(owner=self.user, email='anna@ivanov.ru', full_name='Анна Иванова')
+        Client.objects.create(owner=self.other, email='ivan@other.ru', full_name='Иван Чужой')
+        self.client.force_login(self.user)
+
+    def texts(self, term):
+        response = self.client.get(reverse('client_autocomplete'), {'q': term})
+        return [item['text'] for item in response.json()['results']]
+
+    def test_prefix_is_case_insensitive_and_scoped_to_owner(self):
+        self.assertEqual(self.texts('ив'), ['Иван Петров (Ivan@example.com)'])
+        self.assertEqual(self.texts('IVAN'), ['Иван Петров (Ivan@example.com)'])
+        self.assertEqual(self.texts('анна'), ['Анна Иванова (anna@ivanov.ru)'])
+
+    def test_short_term_returns_nothing(self):
+        self.assertEqual(self.texts('и'), [])
+
+
+class DeliveryLeaseTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='owner')
+        domains = ('a.example', 'b.example', 'c.example', 'd.example', 'e.example')
+        self.mailing = make_mailing(self.user, make_clients(self.user, 30, domains))
+        with mailing_run(self.mailing) as run:
+            self.run = run
+            enqueue_mailing(self.mailing, run)
+
+    def claim(self, worker_id, batch_size=10, lease_seconds=60, shard=0, shards=1):
+        return claim_deliveries(worker_id, shard, shards, batch_size, lease_seconds, [self.run.pk])
+
+    def test_leased_rows_are_not_claimed_twice(self):
+        first = {d.pk for d in self.claim('worker-1')}
+        second = {d.pk for d in self.claim('worker-2')}
+        self.assertEqual(len(first), 10)
+        self.assertEqual(len(second), 10)
+        self.assertFalse(first & second)
+        self.assertEqual(Delivery.objects.filter(pk__in=first, lease_owner='worker-1', attempts=1).count(), 10)
+
+    def test_expired_lease_is_reclaimed(self):
+        claimed = self.claim('worker-1', batch_size=30)
+        self.assertEqual(self.claim('worker-2', batch_size=30), [])
+
+        # Воркер 1 "упал": его аренда истекла
+        Delivery.objects.update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        reclaimed = self.claim('worker-2', batch_size=30)
+        self.assertEqual({d.pk for d in reclaimed}, {d.pk for d in claimed})
+        self.assertTrue(all(d.attempts == 2 for d in reclaimed))
+
+        # Поздний результат воркера 1 не трогает строки, которые забрал воркер 2
+        record_deliveries([(d, ('success', 'OK', False)) for d in claimed], 'worker-1')
+        self.assertEqual(Delivery.objects.filter(status='pending', lease_owner='worker-2').count(), 30)
+
+    def test_shards_are_disjoint_and_keep_domains_together(self):
+        shards = 3
+        parts = [set(_pending(shard, shards, [self.run.pk]).values_list('pk', flat=True)) for shard in range(shards)]
+        self.assertEqual(sum(len(part) for part in parts), 30)
+        self.assertEqual(set().union(*parts), set(Delivery.objects.values_list('pk', flat=True)))
+        for shard, part in enumerate(parts):
+            domains = set(Delivery.objects.filter(pk__in=part).values_list('domain', flat=True))
+            others = Delivery.objects.exclude(pk__in=part).filter(domain__in=domains)
+            self.assertFalse(others.exists(), f'домен шарда {shard} попал в другой шард')
+
+    def test_sharded_workers_send_each_recipient_once(self):
+        shards = 3
+        sent = sum(run_delivery_worker(shard, shards, 10, 60, [self.run.pk])[0] for shard in range(shards))
+        self.assertEqual(sent, 30)
+        self.assertEqual(len(mail.outbox), 30)
+        self.assertEqual(len({message.to[0] for message in mail.outbox}), 30)
+        self.assertEqual(Delivery.objects.filter(status='sent').count(), 30)
+        self.assertEqual(MailingAttempt.objects.filter(mailing=self.mailing).count(), 30)
+
+    def test_domain_quota_is_applied_in_one_claim(self):
+        claimed = claim_deliveries(
+            'worker-1', 0, 1, 30, 60, [self.run.pk],
+            exclude_domains={'e.example'}, domain_quota=lambda domain: 2,
+        )
+        domains = [d.domain for d in claimed]
+        self.assertEqual(len(claimed), 8)
+        self.assertEqual({domain: domains.count(domain) for domain in domains},
+                         {'a.example': 2, 'b.example': 2, 'c.example': 2, 'd.example': 2})
+
+    def test_released_rows_keep_their_attempts(self):
+        claimed = self.claim('worker-1')
+        release_deliveries(claimed, 'worker-1')
+        self.assertEqual(Delivery.objects.filter(pk__in=[d.pk for d in claimed], attempts=0, lease_owner='').count(), 10)
+        self.assertEqual(len(self.claim('worker-2', batch_size=30)), 30)
+
+
+@override_settings(MAILING_SEND_THREADS=4)
+class SlowDeliveryTest(TestCase):
+    """Отправка всей очереди дольше аренды: взятое не должно истекать в очереди"""
+
+    def setUp(self):
+        user = get_user_model().objects.create(username='owner')
+        domains = [f'd{i}.example' for i in range(20)]
+        self.mailing = make_mailing(user, make_clients(user, 200, domains))
+        with mailing_run(self.mailing) as run:
+            self.run = run
+            enqueue_mailing(self.mailing, run)
+
+    def test_no_recipient_fails_without_attempt(self):
+        deliver = services.deliver_message
+
+        def slow_deliver(*args, **kwargs):
+            time.sleep(0.02)
+            return deliver(*args, **kwargs)
+
+        with mock.patch.object(services, 'deliver_message', slow_deliver):
+            sent, failed = run_delivery_worker(0, 1, 100, 0.3, [self.run.pk])
+        self.assertEqual((sent, failed), (200, 0))
+        self.assertEqual(Delivery.objects.filter(status='sent').count(), 200)
+        self.assertEqual(MailingAttempt.objects.filter(mailing=self.mailing).count(), 200)
+
+
+@override_settings(MAILING_DOMAIN_LIMITS={
+    'slow.example': {'concurrency': 2, 'rate': 0},
+    'rate.example': {'concurrency': 4, 'rate': 20},
+})
+class DomainDispatcherTest(TestCase):
+    def run_dispatcher(self, send, items, threads=8):
+        dispatcher = DomainDispatcher(send, threads)
+        for domain, values in items.items():
+            dispatcher.add(domain, values)
+        done = []
+        while dispatcher.pending():
+            done.extend(dispatcher.collect(timeout=0.1))
+        dispatcher.close()
+        return done
+
+    def test_concurrency_is_capped_per_domain(self):
+        lock = threading.Lock()
+        active = Counter()
+        peak = Counter()
+
+        def send(domain):
+            with lock:
+                active[domain] += 1
+                peak[domain] = max(peak[domain], active[domain])
+            time.sleep(0.02)
+            with lock:
+                active[domain] -= 1
+            return 'ok'
+
+        done = self.run_dispatcher(send, {'slow.example': ['slow.example'] * 10, 'fast.example': ['fast.example'] * 10})
+        self.assertEqual(len(done), 20)
+        self.assertEqual(peak['slow.example'], 2)
+        # Лимит по умолчанию - 4 одновременных отправки
+        self.assertEqual(peak['fast.example'], 4)
+
+    def test_rate_is_capped_per_domain(self):
+        started = []
+
+        def send(item):
+            started.append(time.monotonic())
+            return 'ok'
+
+        self.run_dispatcher(send, {'rate.example': list(range(6))})
+        started.sort()
+        gaps = [later - earlier for earlier, later in zip(started, started[1:])]
+        # 20 писем в секунду - не чаще одного раза в 50 мс (с запасом на таймер)
+        self.assertGreaterEqual(min(gaps), 0.045)
+
+
+class MailingRunLockTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='owner')
+        self.mailing = make_mailing(self.user, make_clients(self.user, 3))
+
+    def test_concurrent_trigger_collapses(self):
+        with mailing_run(self.mailing) as run:
+            self.assertIsNotNone(run)
+            # Второй запуск, пока первый держит блокировку
+            self.assertIsNone(send_mailing(self.mailing))
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(self.mailing.runs.count(), 1)
+
+    def test_expired_lock_can_be_taken(self):
+        Mailing.objects.filter(pk=self.mailing.pk).update(run_lock_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(send_mailing(self.mailing), (3, 0, 0))
+
+    def test_sequential_triggers_collapse(self):
+        self.assertEqual(send_mailing(self.mailing), (3, 0, 0))
+        self.assertEqual(send_mailing(self.mailing), (0, 0, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(self.mailing.runs.count(), 1)
+        self.assertEqual(MailingAttempt.objects.filter(mailing=self.mailing).count(), 3)
+
+    def test_repeat_trigger_sends_only_to_new_recipients(self):
+        send_mailing(self.mailing)
+        newcomer = Client.objects.create(owner=self.user, email='new@example.com', full_name='Новый')
+        self.mailing.clients.add(newcomer)
+        self.assertEqual(send_mailing(self.mailing), (1, 0, 0))
+        self.assertEqual([message.to for message in mail.outbox[3:]], [['new@example.com']])
+
+    def test_explicit_resend_starts_new_run(self):
+        send_mailing(self.mailing)
+        self.assertEqual(send_mailing(self.mailing, resend=True), (3, 0, 0))
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(self.mailing.runs.count(), 2)
+
+    def test_send_view_reports_already_sent(self):
+        self.client.force_login(self.user)
+        url = reverse('send_mailing', args=[self.mailing.pk])
+        self.client.get(url)
+        response = self.client.get(url)
+        last = list(get_messages(response.wsgi_request))[-1]
+        self.assertEqual(str(last), 'ℹ️ Рассылка уже отправлена всем получателям')
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_temporary_failure_is_retried_on_later_pass_after_delay(self):
+        down = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        with mock.patch.object(services, 'send_mail', side_effect=down):
+            self.assertEqual(send_mailing(self.mailing), (0, 0, 3))
+            # Пауза еще не прошла: повторный запуск не нагружает сервер
+            self.assertEqual(send_mailing(self.mailing), (0, 0, 3))
+
+        self.assertEqual(MailingAttempt.objects.filter(mailing=self.mailing, status='failed').count(), 3)
+        self.assertEqual(DeliveryStat.objects.get(mailing=self.mailing, status='failed').count, 3)
+        retry_at = timezone.now() + timedelta(seconds=250)
+        self.assertEqual(Delivery.objects.filter(
+            status='pending', attempts=1, lease_owner='', lease_expires_at__gt=retry_at,
+        ).count(), 3)
+
+        Delivery.objects.update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(send_mailing(self.mailing), (3, 0, 0))
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_permanent_failure_is_not_retried(self):
+        rejected = smtplib.SMTPRecipientsRefused({'client@example.com': (550, b'No such user')})
+        with mock.patch.object(services, 'send_mail', side_effect=rejected):
+            self.assertEqual(send_mailing(self.mailing), (0, 3, 0))
+        self.assertEqual(Delivery.objects.filter(status='failed', attempts=1).count(), 3)
+        self.assertEqual(MailingAttempt.objects.filter(mailing=self.mailing).count(), 3)
+
+    def test_send_view_counts_recipients_not_attempts(self):
+        self.client.force_login(self.user)
+        with mock.patch.object(services, 'send_mail', side_effect=smtplib.SMTPConnectError(421, b'Try later')):
+            response = self.client.get(reverse('send_mailing', args=[self.mailing.pk]))
+        last = list(get_messages(response.wsgi_request))[-1]
+        self.assertEqual(str(last), '⚠️ Все отправки завершились с ошибкой. Неудачно: 0, повтор позже: 3')
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='owner', is_staff=True)
+        self.mailing = make_mailing(self.user, make_clients(self.user, 3))
+        self.addCleanup(metrics.mailing_messages_total.take)
+        self.addCleanup(metrics.mailing_smtp_duration_seconds.take)
+
+    def test_send_totals_are_persisted_for_other_processes(self):
+        send_mailing(self.mailing)
+        sent = MetricTotal.objects.get(metric='mailing_messages_total', labels='["success"]', field='value')
+        self.assertEqual(sent.value, 3)
+        self.assertEqual(MetricTotal.objects.get(metric='mailing_smtp_duration_seconds', field='count').value, 3)
+        # Значения процесса обнулены: при следующей записи не прибавятся дважды
+        self.assertEqual(metrics.mailing_messages_total.take(), {})
+
+    def test_metrics_view_sums_process_and_persisted_values(self):
+        # Итог воркеров send_workers и значение текущего процесса
+        MetricTotal.objects.create(metric='mailing_messages_total', labels='["failed"]', field='value', value=5)
+        metrics.mailing_messages_total.inc(status='failed')
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('metrics'))
+        self.assertRegex(response.content.decode(), r'mailing_messages_total\{status="failed"\} 6(\.0)?\n')
+
+    def test_failed_persist_keeps_values(self):
+        metrics.mailing_messages_total.inc(status='success')
+        with mock.patch('mailing.metrics._bump', side_effect=DatabaseError('locked')):
+            with self.assertLogs('mailing.metrics', 'ERROR'):
+                metrics.persist()
+        self.assertEqual(metrics.mailing_messages_total.take(), {('success',): 1})
+
+    def test_metrics_are_for_staff_only_by_default(self):
+        self.client.force_login(get_user_model().objects.create(username='visitor'))
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1').status_code, 403)
+        with override_settings(METRICS_ALLOWED_IPS=['10.0.0.5']):
+            self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.5').status_code, 200)
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0.0)
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.profiles = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profiles.cleanup)
+        self.enterContext(override_settings(PROFILING_DIR=self.profiles.name))
+
+    def test_superuser_request_is_profiled(self):
+        self.client.force_login(get_user_model().objects.create(username='admin', is_superuser=True))
+        self.assertEqual(self.client.get(reverse('client_list'), {'_profile': ''}).status_code, 200)
+
+        profile = RequestProfile.objects.get()
+        self.assertEqual((profile.view_name, profile.status_code), ('client_list', 200))
+        self.assertGreater(profile.query_count, 0)
+        with open(profile.profile_file, 'rb') as f:
+            self.assertTrue(f.read())
+        with open(profile.queries_file, encoding='utf-8') as f:
+            self.assertIn('"sql"', f.read())
+
+    def test_header_is_ignored_for_other_users(self):
+        self.client.force_login(get_user_model().objects.create(username='owner'))
+        self.client.get(reverse('client_list'), HTTP_X_PROFILE='1')
+        self.assertFalse(RequestProfile.objects.exists())
+        self.assertEqual(list(Path(self.profiles.name).iterdir()), [])
+
+    def test_disabled_middleware_is_not_used(self):
+        with override_settings(PROFILING_ENABLED=False), self.assertRaises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: None)
+
+
+class SMTPSinkTest(TestCase):
+    def test_sends_through_sink(self):
+        with SMTPSink(port=0) as sink:
+            connection = get_connection('django.core.mail.backends.smtp.EmailBackend',
+                                        host=sink.host, port=sink.port)
+            with connection:
+                send_mail('Тема', 'Текст', 'from@example.com', ['to@example.com'], connection=connection)
+        self.assertEqual(sink.stats.accepted, 1)
+
+    def test_start_raises_when_port_is_busy(self):
+        with SMTPSink(port=0) as sink:
+            with self.assertRaises(OSError):
+                SMTPSink(port=sink.port).start(timeout=5)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', MAILING_SEND_THREADS=1)
+    def test_worker_reconnects_after_server_closes_connection(self):
+        user = get_user_model().objects.create(username='owner')
+        mailing = make_mailing(user, make_clients(user, 6))
+        # Сервер закрывает соединение после каждых двух писем
+        with SMTPSink(port=0, max_messages=2) as sink:
+            with override_settings(EMAIL_HOST=sink.host, EMAIL_PORT=sink.port), mailing_run(mailing) as run:
+                enqueue_mailing(mailing, run)
+                run_delivery_worker(0, 1, 100, 60, [run.pk])
+
+        statuses = ''.join(
+            MailingAttempt.objects.filter(mailing=mailing).order_by('pk').values_list('status', flat=True)
+        )
+        # Закрытое соединение стоит одной неудачной попытки, следующее письмо уходит по новому
+        self.assertNotIn('failedfailed', statuses)
+        self.assertGreaterEqual(sink.stats.accepted, 4)
+        self.assertEqual(sink.stats.accepted, statuses.count('success'))
+        self.assertGreater(sink.stats.connections, 1)
+
+
+class StaticFilesTest(TestCase):
+    def test_url_without_collectstatic_falls_back_to_source_name(self):
+        with tempfile.TemporaryDirectory() as static_root, override_settings(STATIC_ROOT=static_root):
+            self.assertEqual(staticfiles_storage.url('mailing/css/main.css'), '/static/mailing/css/main.css')
+
+
+class ConditionalListTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='owner')
+        self.clients = make_clients(self.user, 3)
+        self.mailing = make_mailing(self.user, self.clients)
+        self.client.force_login(self.user)
+        self.url = reverse('mailing_list')
+
+    def revalidate(self):
+        etag = self.client.get(self.url)['ETag']
+        return lambda: self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code
+
+    def test_unchanged_list_is_not_modified(self):
+        self.assertEqual(self.revalidate()(), 304)
+
+    def test_recipient_changes_invalidate_list(self):
+        changes = [
+            lambda: self.clients[0].soft_delete(),
+            lambda: self.clients[1].delete(),
+            lambda: self.mailing.clients.remove(self.clients[2]),
+            lambda: self.clients[2].mailing_set.add(self.mailing),
+        ]
+        for change in changes:
+            status = self.revalidate()
+            change()
+            self.assertEqual(status(), 200)
+
+
+@override_settings(TRACKING_ENABLED=True, TRACKING_BASE_URL='https://mailing.example.com/')
+class TrackingTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='owner')
+        self.clients = make_clients(self.user, 2)
+        self.mailing = make_mailing(self.user, self.clients)
+
+    def click_urls(self, body):
+        html = tracking.render_html(body, self.mailing.pk, self.clients[0].pk)
+        tokens = re.findall(r'/t/c/([^/"]+)/', html)
+        return [tracking.parse_token(token)[2] for token in tokens], html
+
+    def test_trailing_punctuation_is_not_part_of_link(self):
+        urls, html = self.click_urls('См. https://example.com/x. И (https://example.com/y), https://e.com/Foo_(bar)!')
+        self.assertEqual(urls, ['https://example.com/x', 'https://example.com/y', 'https://e.com/Foo_(bar)'])
+        self.assertIn('</a>.', html)
+        self.assertIn('href="https://mailing.example.com/t/c/', html)
+
+    def test_loopback_base_url_refuses_to_send(self):
+        for base_url in ('', 'http://127.0.0.1:8000', 'http://localhost/'):
+            with self.subTest(base_url=base_url), override_settings(TRACKING_BASE_URL=base_url):
+                with self.assertRaises(ImproperlyConfigured):
+                    send_mailing(self.mailing)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(MailingAttempt.objects.exists())
+
+    def test_events_of_purged_objects_do_not_lose_batch(self):
+        events = tracking.EventBuffer(flush_size=100, flush_interval=60)
+        events.add('open', self.mailing.pk, self.clients[0].pk)
+        events.add('open', self.mailing.pk, self.clients[0].pk)
+        events.add('click', self.mailing.pk, 999999)
+        events.add('open', 999999, self.clients[1].pk)
+        self.assertEqual(events.flush(), 2)
+        event = TrackingEvent.objects.get()
+        self.assertEqual((event.kind, event.client_id, event.count), ('open', self.clients[0].pk, 2))
+
+    def test_failed_write_is_logged_and_requeued(self):
+        events = tracking.EventBuffer(flush_size=100, flush_interval=60)
+        events.add('open', self.mailing.pk, self.clients[0].pk)
+        with mock.patch('mailing.tracking._write_events', side_effect=DatabaseError('locked')):
+            with self.assertLogs('mailing.tracking', 'ERROR'):
+                self.assertEqual(events.flush(), 0)
+        self.assertEqual(len(events.events), 1)
+        self.assertEqual(events.flush(), 1)
+
+
+class TrackingFlushTimerTest(TransactionTestCase):
+    def test_idle_buffer_is_flushed_by_timer(self):
+        user = get_user_model().objects.create(username='owner')
+        clients = make_clients(user, 1)
+        mailing = make_mailing(user, clients)
+        events = tracking.EventBuffer(flush_size=100, flush_interval=0.05)
+        events.add('open', mailing.pk, clients[0].pk)
+
+        # Ждем по буферу, а не запросами к БД: SQLite в памяти не ждет блокировку
+        # таблицы, и параллельное чтение с записью потока сброса падает
+        deadline = time.monotonic() + 5
+        while (events.events or events.flushing.locked()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(TrackingEvent.objects.get().count, 1)
+
+
+class PurgeTest(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create(username='owner')
+        self.other = get_user_model().objects.create(username='other')
+        self.mailing = self.sent_mailing(self.owner, 'owner.example')
+        self.other_mailing = self.sent_mailing(self.other, 'other.example')
+
+    def sent_mailing(self, owner, domain):
+        clients = make_clients(owner, 2, (domain,))
+        mailing = make_mailing(owner, clients)
+        send_mailing(mailing)
+        now = timezone.now()
+        TrackingEvent.objects.create(
+            mailing=mailing, client=clients[0], kind='open', day=now.date(), count=1, first_seen=now, last_seen=now,
+        )
+        return mailing
+
+    def dependents(self, **lookup):
+        """Количество зависимых строк по mailing=… или client=…"""
+        counts = {
+            model.__name__: model.objects.filter(**lookup).count()
+            for model in (Delivery, TrackingEvent)
+        }
+        counts['recipients'] = Mailing.clients.through.objects.filter(
+            **{f'{name}_id': value.pk for name, value in lookup.items()}
+        ).count()
+        if 'mailing' in lookup:
+            for model in (MailingAttempt, DeliveryStat, MailingRun):
+                counts[model.__name__] = model.objects.filter(**lookup).count()
+        return counts
+
+    def assert_consistent(self):
+        # Внешние ключи SQLite проверяются при COMMIT, в TestCase его нет - проверяем явно
+        connection.check_constraints()
+
+    def test_purge_mailing_removes_history_only_of_that_mailing(self):
+        other_before = self.dependents(mailing=self.other_mailing)
+        purge_mailing(self.mailing.pk, batch_size=1)
+
+        self.assertFalse(Mailing.all_objects.filter(pk=self.mailing.pk).exists())
+        self.assertEqual(set(self.dependents(mailing=self.mailing).values()), {0})
+        self.assertEqual(self.dependents(mailing=self.other_mailing), other_before)
+        self.assertEqual(Client.objects.filter(owner=self.owner).count(), 2)
+        self.assert_consistent()
+
+    def test_purge_client_removes_its_deliveries_and_index_entry(self):
+        client = Client.objects.create(owner=self.owner, email='ivan@owner.example', full_name='Иван Петров')
+        self.mailing.clients.add(client)
+        send_mailing(self.mailing)
+        self.assertEqual(search.search(Client, 'иван', self.owner), [client])
+
+        purge_client(client.pk, batch_size=1)
+
+        self.assertFalse(Client.all_objects.filter(pk=client.pk).exists())
+        self.assertEqual(set(self.dependents(client=client).values()), {0})
+        self.assertEqual(search.search(Client, 'иван', self.owner), [])
+        # Рассылка и остальные получатели на месте
+        self.assertEqual(self.mailing.clients.count(), 2)
+        self.assertEqual(Delivery.objects.filter(mailing=self.mailing).count(), 2)
+        self.assert_consistent()
+
+    def test_purge_message_removes_its_mailings(self):
+        purge_message(self.mailing.message_id, batch_size=1)
+
+        self.assertFalse(Message.all_objects.filter(pk=self.mailing.message_id).exists())
+        self.assertFalse(Mailing.all_objects.filter(pk=self.mailing.pk).exists())
+        self.assertEqual(set(self.dependents(mailing=self.mailing).values()), {0})
+        self.assertTrue(Mailing.objects.filter(pk=self.other_mailing.pk).exists())
+        self.assert_consistent()
+
+    def test_purge_owner_keeps_other_owners_deleted_rows(self):
+        other_client = Client.objects.filter(owner=self.other).first()
+        other_client.soft_delete()
+
+        purge_owner(self.owner.pk, batch_size=1)
+
+        self.assertFalse(get_user_model().objects.filter(pk=self.owner.pk).exists())
+        for model in (Client, Message, Mailing):
+            self.assertFalse(model.all_objects.filter(owner_id=self.owner.pk).exists())
+        # Помеченный клиент другого пользователя ждет своего purge_deleted
+        self.assertTrue(Client.all_objects.filter(pk=other_client.pk, is_deleted=True).exists())
+        self.assertEqual(Delivery.objects.filter(mailing=self.other_mailing).count(), 2)
+        self.assert_consistent()
+
+
+class AuthCacheTest(TestCase):
+    """Пользователь с группами кешируется: лишение прав должно действовать со следующего запроса"""
+
+    def setUp(self):
+        self.managers = Group.objects.create(name='Менеджеры')
+        self.user = get_user_model().objects.create(username='manager')
+        self.user.groups.add(self.managers)
+        owner = get_user_model().objects.create(username='owner')
+        self.url = reverse('client_detail', args=[make_clients(owner, 1)[0].pk])
+        self.client.force_login(self.user)
+        # Первый запрос кладет пользователя в кеш
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertIsNotNone(cache.get(user_cache_key(self.user.pk)))
+
+    def test_removed_from_group_by_user(self):
+        self.user.groups.remove(self.managers)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_removed_from_group_by_group(self):
+        self.managers.user_set.remove(self.user)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_group_renamed(self):
+        self.managers.name = 'Бывшие менеджеры'
+        self.managers.save()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_deactivated_user_is_logged_out(self):
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith(settings.LOGIN_URL))
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create(username='owner')
+        self.client_obj = Client.objects.create(
+            owner=self.owner, email='ivan@example.com', full_name='Пётр Иванов', comment='постоянный',
+        )
+        self.message = Message.objects.create(owner=self.owner, subject='Скидки недели', body='Только до пятницы')
+
+    def test_created_objects_are_found_by_prefix_and_yo(self):
+        for query in ('петр', 'Пётр', 'ива', 'пётр ив', 'ivan'):
+            with self.subTest(query=query):
+                self.assertEqual(search.search(Client, query, self.owner), [self.client_obj])
+        self.assertEqual(search.search(Message, 'скид пятн', self.owner), [self.message])
+
+    def test_edit_reindexes(self):
+        self.client_obj.full_name = 'Семён Смирнов'
+        self.client_obj.save()
+        self.assertEqual(search.search_ids(Client, 'иванов'), [])
+        self.assertEqual(search.search(Client, 'семен', self.owner), [self.client_obj])
+
+    def test_deleted_objects_leave_index(self):
+        self.client_obj.soft_delete()
+        self.assertEqual(search.search_ids(Client, 'петр'), [])
+        self.message.delete()
+        self.assertEqual(search.search_ids(Message, 'скидки'), [])
+
+    def test_purge_removes_rows_marked_without_signals(self):
+        # Так помечает purge_owner: update() без сигналов, строка остается в индексе
+        Client.all_objects.filter(pk=self.client_obj.pk).update(is_deleted=True)
+        self.assertEqual(search.search_ids(Client, 'петр'), [self.client_obj.pk])
+        self.assertEqual(search.search(Client, 'петр', self.owner), [])
+
+        purge_client(self.client_obj.pk, batch_size=100)
+        self.assertEqual(search.search_ids(Client, 'петр'), [])
+
+    def test_results_are_scoped_to_owner(self):
+        other = get_user_model().objects.create(username='other')
+        stranger = Client.objects.create(owner=other, email='petr@example.org', full_name='Пётр Сидоров')
+        self.assertEqual(search.search(Client, 'петр', self.owner), [self.client_obj])
+        self.assertEqual(search.search(Client, 'петр', other), [stranger])
+        self.assertEqual({c.pk for c in search.search(Client, 'петр')}, {self.client_obj.pk, stranger.pk})
+
+    def test_tables_are_created_after_migrate(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE mailing_client_fts')
+        emit_post_migrate_signal(verbosity=0, interactive=False, db='default')
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE name = 'mailing_client_fts'")
+            self.assertIsNotNone(cursor.fetchone())
+
+    def test_view_accepts_fts_syntax_as_plain_text(self):
+        self.client.force_login(self.owner)
+        for query in ('_', '"', 'AND', 'NEAR', 'ivan OR', 'NEAR(ivan', '*', 'петр"'):
+            with self.subTest(query=query):
+                response = self.client.get(reverse('search'), {'q': query})
+                self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('search'), {'q': '"петр"'})
+        self.assertEqual(list(response.context['clients']), [self.client_obj])
+
+
+class DeliveryStatsTest(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create(username='owner')
+        self.other = get_user_model().objects.create(username='other')
+        self.mailing = make_mailing(self.owner, make_clients(self.owner, 3, ('owner.example',)))
+        self.other_mailing = make_mailing(self.other, make_clients(self.other, 2, ('other.example',)))
+        send_mailing(self.mailing)
+        send_mailing(self.other_mailing)
+        with mock.patch.object(services, 'send_mail', side_effect=smtplib.SMTPConnectError(421, b'Try later')):
+            send_mailing(self.mailing, resend=True)
+
+    def stats(self):
+        return sorted(DeliveryStat.objects.values_list('day', 'mailing_id', 'owner_id', 'status', 'count'))
+
+    def test_incremental_stats_match_rebuild(self):
+        incremental = self.stats()
+        self.assertEqual(len(incremental), 3)
+        self.assertEqual(rebuild_delivery_stats(), 3)
+        self.assertEqual(self.stats(), incremental)
+
+    def test_report_is_scoped_to_owner(self):
+        self.client.force_login(self.owner)
+        report = self.client.get(reverse('mailing_report_api')).json()
+        self.assertEqual(report['mailings'], [
+            {'mailing': self.mailing.pk, 'owner': 'owner', 'success': 3, 'failed': 3, 'success_rate': 50.0},
+        ])
+        self.assertEqual([(day['success'], day['failed']) for day in report['days']], [(3, 3)])
+
+    def test_report_hides_deleted_mailings(self):
+        self.mailing.soft_delete()
+        self.client.force_login(self.owner)
+        report = self.client.get(reverse('mailing_report_api')).json()
+        self.assertEqual((report['days'], report['mailings']), ([], []))
+
+
+class SegmentTest(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create(username='owner')
+        other = get_user_model().objects.create(username='other')
+        self.clients = {
+            name: Client.objects.create(owner=owner, email=email, full_name=name, comment=comment)
+            for name, owner, email, comment in [
+                ('a', self.owner, 'a@gmail.com', 'VIP, Москва'),
+                ('b', self.owner, 'b@GMAIL.com', 'vip'),
+                ('c', self.owner, 'c@mail.ru', 'vip москва'),
+                ('d', self.owner, 'd@notgmail.com', 'vip москва'),
+                ('deleted', self.owner, 'deleted@gmail.com', 'vip москва'),
+                ('stranger', other, 'stranger@gmail.com', 'vip москва'),
+            ]
+        }
+        self.clients['deleted'].soft_delete()
+
+    def recipients(self, **filters):
+        segment = Segment.objects.create(owner=self.owner, name='Сегмент', **filters)
+        return {client.full_name for client in segment.get_clients()}
+
+    def test_filters(self):
+        self.assertEqual(self.recipients(), {'a', 'b', 'c', 'd'})
+        self.assertEqual(self.recipients(email_domain='@Gmail.com'), {'a', 'b'})
+        self.assertEqual(self.recipients(comment_tags='vip, москва'), {'a', 'c', 'd'})
+        self.assertEqual(self.recipients(email_domain='gmail.com', comment_tags='москва'), {'a'})
+
+    def test_comment_key_follows_edits_and_bulk_rows(self):
+        client = self.clients['b']
+        client.comment = 'VIP, МОСКВА'
+        client.save(update_fields=['comment'])
+        Client.objects.bulk_create([Client(owner=self.owner, email='e@gmail.com', full_name='e',
+                                           comment='Москва, vip')])
+        self.assertEqual(self.recipients(comment_tags='москва'), {'a', 'b', 'c', 'd'})
+
+        # name_key и comment_key новой строки
+        self.assertEqual(search.fill_search_keys(Client), 2)
+        self.assertEqual(self.recipients(comment_tags='москва'), {'a', 'b', 'c', 'd', 'e'})
+
+    def test_admin_counts_segment_recipients(self):
+        segment = Segment.objects.create(owner=self.owner, name='Gmail', email_domain='gmail.com')
+        mailing = make_mailing(self.owner)
+        mailing.segment = segment
+        mailing.save()
+        self.assertEqual(MailingAdmin(Mailing, admin.site).clients_count(mailing), 2)
+
+    def test_form_rejects_clients_together_with_segment(self):
+        segment = Segment.objects.create(owner=self.owner, name='Gmail', email_domain='gmail.com')
+        start = timezone.localtime() + timedelta(hours=1)
+        data = {
+            'start_time': start.strftime('%Y-%m-%dT%H:%M'),
+            'end_time': (start + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M'),
+            'message': Message.objects.create(owner=self.owner, subject='Тема письма', body='Текст').pk,
+            'clients': [self.clients['c'].pk],
+            'segment': segment.pk,
+        }
+        form = MailingForm(data=data, user=self.owner)
+        self.assertFalse(form.is_valid())
+        self.assertIn('не то и другое', form.non_field_errors()[0])
+
+        del data['clients']
+        self.assertTrue(MailingForm(data=data, user=self.owner).is_valid())
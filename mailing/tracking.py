@@ -0,0 +1,192 @@
+"""Отслеживание открытий и переходов по ссылкам из писем.
+
+Токены подписаны (django.core.signing), поэтому подделать событие или
+перенаправить по чужой ссылке нельзя. Обработчик события только добавляет
+запись в буфер в памяти процесса; в TrackingEvent буфер сбрасывается
+пачкой в фоновом потоке - по размеру, по времени и при завершении процесса.
+"""
+import atexit
+import logging
+import re
+import threading
+from collections import Counter, deque
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import escape
+
+logger = logging.getLogger(__name__)
+
+SALT = 'mailing.tracking'
+URL_RE = re.compile(r'https?://[^\s<>"]+')
+# Знаки препинания после ссылки в тексте письма к ней не относятся
+TRAILING_PUNCTUATION = '.,;:!?)'
+
+
+def make_token(mailing_id, client_id, url=None):
+    payload = [mailing_id, client_id] if url is None else [mailing_id, client_id, url]
+    return signing.dumps(payload, salt=SALT, compress=True)
+
+
+def parse_token(token):
+    """(mailing_id, client_id, url или None); BadSignature для поддельных токенов"""
+    payload = signing.loads(token, salt=SALT)
+    mailing_id, client_id = int(payload[0]), int(payload[1])
+    return mailing_id, client_id, payload[2] if len(payload) > 2 else None
+
+
+def _strip_trailing_punctuation(url):
+    while url and url[-1] in TRAILING_PUNCTUATION:
+        # Закрывающая скобка - часть ссылки, если открывающая тоже в ней (…/Foo_(bar))
+        if url[-1] == ')' and url.count('(') >= url.count(')'):
+            break
+        url = url[:-1]
+    return url
+
+
+def tracking_base_url():
+    """TRACKING_BASE_URL без / в конце.
+
+    Адрес без хоста или на локальной машине получатели не откроют - письма с
+    такими ссылками не отправляем (ImproperlyConfigured).
+    """
+    base_url = settings.TRACKING_BASE_URL.rstrip('/')
+    host = urlsplit(base_url).hostname or ''
+    if host in ('', 'localhost', '0.0.0.0', '::1') or host.startswith('127.'):
+        raise ImproperlyConfigured(
+            f'TRACKING_BASE_URL = {settings.TRACKING_BASE_URL!r} недоступен получателям писем: '
+            f'укажите адрес сайта или выключите TRACKING_ENABLED'
+        )
+    return base_url
+
+
+def render_html(body, mailing_id, client_id):
+    """HTML-версия письма: ссылки через click-редирект и пиксель открытия"""
+    base_url = tracking_base_url()
+    parts = []
+    position = 0
+    for match in URL_RE.finditer(body):
+        parts.append(escape(body[position:match.start()]))
+        url = _strip_trailing_punctuation(match.group(0))
+        click_url = base_url + reverse('track_click', args=[make_token(mailing_id, client_id, url)])
+        parts.append(f'<a href="{escape(click_url)}">{escape(url)}</a>')
+        position = match.start() + len(url)
+    parts.append(escape(body[position:]))
+
+    open_url = base_url + reverse('track_open', args=[make_token(mailing_id, client_id)])
+    html = ''.join(parts).replace('\n', '<br>\n')
+    return f'{html}\n<img src="{escape(open_url)}" width="1" height="1" alt="">'
+
+
+class EventBuffer:
+    def __init__(self, flush_size, flush_interval, max_size=None):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        # Если БД долго недоступна, старые события вытесняются, а не копятся без предела
+        self.events = deque(maxlen=max_size or flush_size * 100)
+        self.flushing = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.starting = threading.Lock()
+
+    def add(self, kind, mailing_id, client_id):
+        # deque.append потокобезопасен, блокировка на горячем пути не нужна
+        self.events.append((kind, mailing_id, client_id, timezone.now()))
+        self._ensure_thread()
+        if len(self.events) >= self.flush_size:
+            self.wake.set()
+
+    def _ensure_thread(self):
+        """Фоновый поток сброса; после fork в дочернем процессе его нет - запускаем заново"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.starting:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='tracking-flush', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        # Сброс по размеру (wake) или по времени, даже если новых событий нет
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            if self.events:
+                try:
+                    self.flush()
+                finally:
+                    # У каждого потока свое соединение с БД
+                    connection.close()
+
+    def flush(self):
+        """Записывает накопленные события, возвращает количество записанных"""
+        if not self.flushing.acquire(blocking=False):
+            return 0
+        try:
+            events = [self.events.popleft() for _ in range(len(self.events))]
+            if not events:
+                return 0
+            close_old_connections()
+            try:
+                return _write_events(events)
+            except Exception:
+                # Вернем события в буфер, следующий сброс повторит запись
+                logger.exception('Не удалось записать %d событий отслеживания', len(events))
+                self.events.extendleft(reversed(events))
+                return 0
+        finally:
+            self.flushing.release()
+
+
+def _existing_ids(model, ids):
+    return set(model.all_objects.filter(pk__in=ids).values_list('pk', flat=True))
+
+
+def _write_events(events):
+    """Агрегирует события и пишет их в TrackingEvent, возвращает количество записанных.
+
+    События удаленных (purge) рассылок и клиентов отбрасываются: FK-ошибка
+    одной строки в SQLite проявляется только при COMMIT и отменила бы всю пачку.
+    """
+    from .models import Client, Mailing, TrackingEvent
+
+    mailing_ids = _existing_ids(Mailing, {event[1] for event in events})
+    client_ids = _existing_ids(Client, {event[2] for event in events})
+    counts = Counter()
+    seen = {}
+    for kind, mailing_id, client_id, moment in events:
+        if mailing_id not in mailing_ids or client_id not in client_ids:
+            continue
+        key = (mailing_id, client_id, kind, timezone.localdate(moment))
+        counts[key] += 1
+        first, last = seen.get(key, (moment, moment))
+        seen[key] = (min(first, moment), max(last, moment))
+
+    dropped = len(events) - sum(counts.values())
+    if dropped:
+        logger.info('Пропущено %d событий отслеживания удаленных рассылок или клиентов', dropped)
+
+    with transaction.atomic():
+        for (mailing_id, client_id, kind, day), count in counts.items():
+            first_seen, last_seen = seen[mailing_id, client_id, kind, day]
+            lookup = {'mailing_id': mailing_id, 'client_id': client_id, 'kind': kind, 'day': day}
+            if TrackingEvent.objects.filter(**lookup).update(count=F('count') + count, last_seen=last_seen):
+                continue
+            try:
+                with transaction.atomic():
+                    TrackingEvent.objects.create(
+                        count=count, first_seen=first_seen, last_seen=last_seen, **lookup
+                    )
+            except IntegrityError:
+                # Строку успел создать другой процесс
+                TrackingEvent.objects.filter(**lookup).update(count=F('count') + count, last_seen=last_seen)
+    return sum(counts.values())
+
+
+buffer = EventBuffer(settings.TRACKING_FLUSH_SIZE, settings.TRACKING_FLUSH_INTERVAL)
+atexit.register(buffer.flush)
@@ -21,5 +21,13 @@ urlpatterns = [
     path('mailings/create/', views.mailing_create, name='mailing_create'),
     path('mailings/<int:pk>/update/', views.mailing_update, name='mailing_update'),
     path('mailings/<int:pk>/delete/', views.mailing_delete, name='mailing_delete'),
+    path('reports/', views.mailing_report, name='mailing_report'),
+    path('api/reports/', views.mailing_report_api, name='mailing_report_api'),
+    path('search/', views.search_view, name='search'),
+    path('t/o/<str:token>/', views.track_open, name='track_open'),
+    path('t/c/<str:token>/', views.track_click, name='track_click'),
+    path('autocomplete/clients/', views.client_autocomplete, name='client_autocomplete'),
+    path('autocomplete/messages/', views.message_autocomplete, name='message_autocomplete'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
 
@@ -1,26 +1,75 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
+from django.core import signing
+from django.db.models import Count, Max
+from django.db.models.functions import Lower
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
 from django.core.cache import cache
-from django.core.mail import send_mail
 from django.contrib import messages
-from .models import Client, Message, Mailing, MailingAttempt
+from .models import Client, DeliveryStat, Message, Mailing
 from .forms import ClientForm, MessageForm, MailingForm
+from .services import send_mailing
+from .conditional import conditional_view
+from .stats import delivery_report
+from . import search, tracking
 from django.core.exceptions import PermissionDenied
+from . import metrics
+
+
+def is_manager(user):
+    """Менеджеры и суперпользователи видят объекты всех пользователей.
+
+    Группы берутся из user.groups.all(): CachedModelBackend загружает их
+    вместе с пользователем, поэтому проверка не делает запросов к БД.
+    """
+    return user.is_superuser or any(group.name == 'Менеджеры' for group in user.groups.all())
 
 
 def manager_required(view_func):
     """Декоратор для проверки, что пользователь менеджер"""
 
     def wrapper(request, *args, **kwargs):
-        if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+        if is_manager(request.user):
             return view_func(request, *args, **kwargs)
         raise PermissionDenied
 
     return wrapper
 
 
+def visible(request, model):
+    """Объекты модели, доступные пользователю"""
+    if is_manager(request.user):
+        return model.objects.all()
+    return model.objects.filter(owner=request.user)
+
+
+# Состояние страниц для условных GET-запросов: (последнее изменение, ...)
+def list_state(model, *related):
+    """Список: max(updated_at) и количество строк (ловит удаления)"""
+    def state(request):
+        aggregates = {'last': Max('updated_at'), 'count': Count('pk')}
+        for name in related:
+            aggregates[name] = Max(f'{name}__updated_at')
+        values = visible(request, model).aggregate(**aggregates)
+        last_modified = max((value for name, value in values.items() if name != 'count' and value), default=None)
+        return last_modified, values['count']
+
+    return state
+
+
+def detail_state(model, *related):
+    def state(request, pk):
+        fields = ['updated_at'] + [f'{name}__updated_at' for name in related]
+        values = visible(request, model).filter(pk=pk).values_list(*fields).first()
+        if values is None:
+            return None  # view сам вернет 404
+        return max(value for value in values if value), *values
+
+    return state
+
+
 def home(request):
     """Главная страница со статистикой с кешированием"""
     cache_key = 'home_stats'
@@ -30,11 +79,8 @@ def home(request):
         total_mailings, active_mailings, unique_clients = cached_data
     else:
         total_mailings = Mailing.objects.count()
-        now = timezone.now()
-        active_mailings = Mailing.objects.filter(
-            start_time__lte=now,
-            end_time__gte=now
-        ).count()
+        # Статус задается при сохранении рассылки, переходы по времени - update_mailing_statuses
+        active_mailings = Mailing.objects.filter(status='started').count()
         unique_clients = Client.objects.distinct().count()
         cache.set(cache_key, (total_mailings, active_mailings, unique_clients), 300)
 
@@ -48,9 +94,10 @@ def home(request):
 
 # КЛИЕНТЫ
 @login_required
+@conditional_view(list_state(Client))
 def client_list(request):
     """Список клиентов: менеджеры видят всех, пользователи - только своих"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         clients = Client.objects.all().order_by('full_name')  # Менеджеры видят всех
     else:
         clients = Client.objects.filter(owner=request.user).order_by('full_name')  # Пользователи - только своих
@@ -59,9 +106,10 @@ def client_list(request):
 
 
 @login_required
+@conditional_view(detail_state(Client))
 def client_detail(request, pk):
     """Детальная информация о клиенте"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         client = get_object_or_404(Client, pk=pk)  # Менеджеры видят всех
     else:
         client = get_object_or_404(Client, pk=pk, owner=request.user)  # Пользователи - только своих
@@ -89,7 +137,7 @@ def client_create(request):
 @login_required
 def client_update(request, pk):
     """Редактирование клиента (только своего для пользователей)"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         client = get_object_or_404(Client, pk=pk)  # Менеджеры могут редактировать всех
     else:
         client = get_object_or_404(Client, pk=pk, owner=request.user)  # Пользователи - только своих
@@ -111,13 +159,14 @@ def client_update(request, pk):
 @login_required
 def client_delete(request, pk):
     """Удаление клиента (только своего для пользователей)"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         client = get_object_or_404(Client, pk=pk)  # Менеджеры могут удалять всех
     else:
         client = get_object_or_404(Client, pk=pk, owner=request.user)  # Пользователи - только своих
 
     if request.method == 'POST':
-        client.delete()
+        # Объект скрывается сразу, история удаляется в фоне (purge_deleted)
+        client.soft_delete()
         return redirect('client_list')
 
     return render(request, 'mailing/client_confirm_delete.html', {'client': client})
@@ -125,9 +174,10 @@ def client_delete(request, pk):
 
 # СООБЩЕНИЯ
 @login_required
+@conditional_view(list_state(Message))
 def message_list(request):
     """Список сообщений: менеджеры видят все, пользователи - только свои"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         messages = Message.objects.all().order_by('subject')  # Менеджеры видят все
     else:
         messages = Message.objects.filter(owner=request.user).order_by('subject')  # Пользователи - только своих
@@ -136,9 +186,10 @@ def message_list(request):
 
 
 @login_required
+@conditional_view(detail_state(Message))
 def message_detail(request, pk):
     """Детальная информация о сообщении"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         message = get_object_or_404(Message, pk=pk)  # Менеджеры видят все
     else:
         message = get_object_or_404(Message, pk=pk, owner=request.user)  # Пользователи - только своих
@@ -166,7 +217,7 @@ def message_create(request):
 @login_required
 def message_update(request, pk):
     """Редактирование сообщения (только своего для пользователей)"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         message = get_object_or_404(Message, pk=pk)  # Менеджеры могут редактировать все
     else:
         message = get_object_or_404(Message, pk=pk, owner=request.user)  # Пользователи - только своих
@@ -188,13 +239,14 @@ def message_update(request, pk):
 @login_required
 def message_delete(request, pk):
     """Удаление сообщения (только своего для пользователей)"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         message = get_object_or_404(Message, pk=pk)  # Менеджеры могут удалять все
     else:
         message = get_object_or_404(Message, pk=pk, owner=request.user)  # Пользователи - только своих
 
     if request.method == 'POST':
-        message.delete()
+        # Объект скрывается сразу, история удаляется в фоне (purge_deleted)
+        message.soft_delete()
         return redirect('message_list')
 
     return render(request, 'mailing/message_confirm_delete.html', {'message': message})
@@ -202,9 +254,10 @@ def message_delete(request, pk):
 
 # РАССЫЛКИ
 @login_required
+@conditional_view(list_state(Mailing, 'message'))
 def mailing_list(request):
     """Список рассылок: менеджеры видят все, пользователи - только свои"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         mailings = Mailing.objects.all().order_by('-start_time')  # Менеджеры видят все
     else:
         mailings = Mailing.objects.filter(owner=request.user).order_by('-start_time')  # Пользователи - только своих
@@ -213,9 +266,10 @@ def mailing_list(request):
 
 
 @login_required
+@conditional_view(detail_state(Mailing, 'message'))
 def mailing_detail(request, pk):
     """Детальная информация о рассылке"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         mailing = get_object_or_404(Mailing, pk=pk)  # Менеджеры видят все
     else:
         mailing = get_object_or_404(Mailing, pk=pk, owner=request.user)  # Пользователи - только своих
@@ -243,7 +297,7 @@ def mailing_create(request):
 @login_required
 def mailing_update(request, pk):
     """Редактирование рассылки (только своей для пользователей)"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         mailing = get_object_or_404(Mailing, pk=pk)  # Менеджеры могут редактировать все
     else:
         mailing = get_object_or_404(Mailing, pk=pk, owner=request.user)  # Пользователи - только своих
@@ -265,13 +319,14 @@ def mailing_update(request, pk):
 @login_required
 def mailing_delete(request, pk):
     """Удаление рассылки (только своей для пользователей)"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         mailing = get_object_or_404(Mailing, pk=pk)  # Менеджеры могут удалять все
     else:
         mailing = get_object_or_404(Mailing, pk=pk, owner=request.user)  # Пользователи - только своих
 
     if request.method == 'POST':
-        mailing.delete()
+        # Объект скрывается сразу, история удаляется в фоне (purge_deleted)
+        mailing.soft_delete()
         return redirect('mailing_list')
 
     return render(request, 'mailing/mailing_confirm_delete.html', {'mailing': mailing})
@@ -281,50 +336,37 @@ def mailing_delete(request, pk):
 @login_required
 def send_mailing_now(request, pk):
     """Ручной запуск рассылки"""
-    if request.user.groups.filter(name='Менеджеры').exists() or request.user.is_superuser:
+    if is_manager(request.user):
         mailing = get_object_or_404(Mailing, pk=pk)  # Менеджеры могут запускать все
     else:
         mailing = get_object_or_404(Mailing, pk=pk, owner=request.user)  # Пользователи - только свои
 
     now = timezone.now()
     if mailing.start_time <= now <= mailing.end_time:
-        sent_count = 0
-        failed_count = 0
-
-        for client in mailing.clients.all():
-            try:
-                send_mail(
-                    subject=mailing.message.subject,
-                    message=mailing.message.body,
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[client.email],
-                    fail_silently=False,
-                )
-                # Запись успешной попытки
-                MailingAttempt.objects.create(
-                    mailing=mailing,
-                    status='success',
-                    server_response=f'Успешно отправлено клиенту {client.email}'
-                )
-                sent_count += 1
-            except Exception as e:
-                # Запись неудачной попытки
-                MailingAttempt.objects.create(
-                    mailing=mailing,
-                    status='failed',
-                    server_response=f'Ошибка: {str(e)}'
-                )
-                failed_count += 1
-
-        if sent_count > 0:
+        # ?resend=1 - отправить всем заново, иначе только тем, кому еще не отправлено
+        result = send_mailing(mailing, request.user, resend=request.GET.get('resend') == '1')
+
+        if result is None:
+            messages.warning(
+                request,
+                '⏳ Рассылка уже отправляется, повторный запуск не требуется'
+            )
+            return redirect('mailing_list')
+
+        # Счет по получателям: временные ошибки повторятся при следующем запуске
+        sent_count, failed_count, retry_count = result
+        retry_note = f', повтор позже: {retry_count}' if retry_count else ''
+        if not sent_count and not failed_count and not retry_count:
+            messages.info(request, 'ℹ️ Рассылка уже отправлена всем получателям')
+        elif sent_count > 0:
             messages.success(
                 request,
-                f'✅ Рассылка отправлена! Успешно: {sent_count}, Неудачно: {failed_count}'
+                f'✅ Рассылка отправлена! Успешно: {sent_count}, Неудачно: {failed_count}{retry_note}'
             )
         else:
             messages.warning(
                 request,
-                f'⚠️ Все отправки завершились с ошибкой. Неудачно: {failed_count}'
+                f'⚠️ Все отправки завершились с ошибкой. Неудачно: {failed_count}{retry_note}'
             )
     else:
         messages.error(
@@ -335,6 +377,151 @@ def send_mailing_now(request, pk):
     return redirect('mailing_list')
 
 
+# ОТЧЕТЫ
+def _report(request):
+    """Отчет по сводке DeliveryStat за ?days= дней (по умолчанию 30)"""
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        days = 30
+    # Удаленные рассылки скрыты сразу, их сводку purge_deleted удалит позже
+    stats = visible(request, DeliveryStat).filter(mailing__is_deleted=False)
+    return delivery_report(stats, max(1, min(days, 365)))
+
+
+@login_required
+def mailing_report(request):
+    """Отчет об успешности доставки по дням и рассылкам"""
+    report = _report(request)
+    peak = max((row['success'] + row['failed'] for row in report['days']), default=0)
+    for row in report['days']:
+        row['width'] = round((row['success'] + row['failed']) * 100 / peak) if peak else 0
+    return render(request, 'mailing/report.html', {'report': report})
+
+
+@login_required
+def mailing_report_api(request):
+    """Тот же отчет в JSON"""
+    return JsonResponse(_report(request))
+
+
+# ОТСЛЕЖИВАНИЕ ОТКРЫТИЙ И ПЕРЕХОДОВ
+TRANSPARENT_GIF = (
+    b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00'
+    b',\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+)
+
+
+def track_open(request, token):
+    """Пиксель открытия письма"""
+    try:
+        mailing_id, client_id, _ = tracking.parse_token(token)
+    except signing.BadSignature:
+        pass  # Пиксель отдаем в любом случае, чтобы не ломать письмо
+    else:
+        tracking.buffer.add('open', mailing_id, client_id)
+
+    response = HttpResponse(TRANSPARENT_GIF, content_type='image/gif')
+    response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    return response
+
+
+def track_click(request, token):
+    """Переход по ссылке из письма: учет и редирект на исходный адрес"""
+    try:
+        mailing_id, client_id, url = tracking.parse_token(token)
+    except signing.BadSignature:
+        raise Http404
+    if not url:
+        raise Http404
+
+    tracking.buffer.add('click', mailing_id, client_id)
+    return HttpResponseRedirect(url)
+
+
+# АВТОДОПОЛНЕНИЕ
+def _autocomplete_params(request):
+    """Строка поиска и ограничение количества результатов"""
+    term = request.GET.get('q', '').strip()
+    try:
+        limit = int(request.GET.get('limit', settings.AUTOCOMPLETE_LIMIT))
+    except ValueError:
+        limit = settings.AUTOCOMPLETE_LIMIT
+    return term, max(1, min(limit, settings.AUTOCOMPLETE_LIMIT))
+
+
+def _prefix_range(prefix):
+    """Границы строк с началом prefix: сравнение идет по индексу, в отличие от LIKE"""
+    return prefix, prefix + '\uffff'
+
+
+@login_required
+def client_autocomplete(request):
+    """Поиск своих клиентов по началу ФИО или email"""
+    term, limit = _autocomplete_params(request)
+    if len(term) < settings.AUTOCOMPLETE_MIN_LENGTH:
+        return JsonResponse({'results': []})
+
+    # Два диапазонных запроса, каждый по своему индексу, вместо OR с общей сортировкой
+    key = term.lower()
+    own = Client.objects.filter(owner=request.user)
+    by_name = own.filter(name_key__range=_prefix_range(key)).order_by('name_key')
+    by_email = (
+        own.annotate(email_key=Lower('email'))
+        .filter(email_key__range=_prefix_range(key))
+        .order_by('email_key')
+    )
+    clients = {}
+    for queryset in (by_name, by_email):
+        for pk, full_name, email in queryset.values_list('pk', 'full_name', 'email')[:limit]:
+            clients.setdefault(pk, (full_name, email))
+
+    return JsonResponse({'results': [
+        {'id': pk, 'text': f'{full_name} ({email})'}
+        for pk, (full_name, email) in list(clients.items())[:limit]
+    ]})
+
+
+@login_required
+def message_autocomplete(request):
+    """Поиск своих сообщений по началу темы"""
+    term, limit = _autocomplete_params(request)
+    if len(term) < settings.AUTOCOMPLETE_MIN_LENGTH:
+        return JsonResponse({'results': []})
+
+    messages = Message.objects.filter(
+        owner=request.user,
+        subject_key__range=_prefix_range(term.lower()),
+    ).order_by('subject_key').values_list('pk', 'subject')[:limit]
+
+    return JsonResponse({'results': [{'id': pk, 'text': subject} for pk, subject in messages]})
+
+
+# ПОИСК
+@login_required
+def search_view(request):
+    """Полнотекстовый поиск по клиентам и сообщениям"""
+    query = request.GET.get('q', '').strip()
+    owner = None if is_manager(request.user) else request.user
+    limit = settings.SEARCH_RESULTS_LIMIT
+    context = {
+        'query': query,
+        'clients': search.search(Client, query, owner, limit) if query else [],
+        'messages_found': search.search(Message, query, owner, limit) if query else [],
+    }
+    return render(request, 'mailing/search.html', context)
+
+
+# МЕТРИКИ
+def metrics_view(request):
+    """Метрики в формате Prometheus: для адресов из METRICS_ALLOWED_IPS и персонала"""
+    is_staff = request.user.is_authenticated and request.user.is_staff
+    if not is_staff and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise PermissionDenied
+
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # ОБРАБОТКА ОШИБОК
 def custom_permission_denied(request, exception=None):
     """Кастомная страница для ошибки 403 (доступ запрещен)"""
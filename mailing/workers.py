@@ -0,0 +1,15 @@
+"""Точка входа процессов send_workers.
+
+Модуль не импортирует модели на верхнем уровне: при старте процесса
+методом spawn (Windows, macOS) Django нужно сначала инициализировать.
+"""
+
+
+def worker_main(shard, shards, batch_size, lease_seconds, run_ids=None):
+    import django
+
+    django.setup()
+
+    from .services import run_delivery_worker
+
+    return run_delivery_worker(shard, shards, batch_size, lease_seconds, run_ids)